@@ -0,0 +1,159 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+import numpy as np
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """
+    Canonicalize a user query so trivially different phrasings share a cache entry.
+    Lowercases, collapses whitespace, and trims trailing ?, ! and . - other punctuation
+    (comparison operators, decimal points, quotes) changes the meaning and is kept.
+    """
+    query = _WHITESPACE_RE.sub(" ", query.lower()).strip()
+    return query.rstrip("?!.").rstrip()
+
+
+def make_key(*parts: str) -> str:
+    """Build a compact cache key from one or more string parts."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class QueryCache:
+    """
+    Bounded in-process LRU cache with a per-entry time-to-live.
+
+    All operations are synchronous and never await, so they are atomic with
+    respect to other coroutines on the event loop and need no lock.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None if missing or expired."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Store value under key, evicting the least recently used entry if full."""
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        self._data.clear()
+
+
+class SemanticCache:
+    """
+    Fixed-size cache keyed by embedding similarity. A lookup returns the value of
+    the most similar stored embedding if its cosine similarity meets the threshold.
+    Once full, the oldest entries are overwritten ring-buffer style.
+    """
+
+    def __init__(self, maxsize: int = 1024, threshold: float = 0.92):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._vectors: Optional[np.ndarray] = None
+        self._values: List[Any] = []
+        self._next = 0
+
+    @staticmethod
+    def _unit(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, embedding: List[float]) -> Optional[Any]:
+        """Return the value for the nearest stored embedding, or None below threshold."""
+        if not self._values:
+            return None
+        scores = self._vectors[:len(self._values)] @ self._unit(embedding)
+        best = int(scores.argmax())
+        return self._values[best] if scores[best] >= self.threshold else None
+
+    def set(self, embedding: List[float], value: Any) -> None:
+        """Store value under embedding, overwriting the oldest entry if full."""
+        vector = self._unit(embedding)
+        if self._vectors is None:
+            self._vectors = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+        index = self._next
+        if index < len(self._values):
+            self._values[index] = value
+        else:
+            self._values.append(value)
+        self._vectors[index] = vector
+        self._next = (index + 1) % self.maxsize
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        self._vectors = None
+        self._values = []
+        self._next = 0
+
+
+# Router intents: keyed by normalized query + conversation context
+intent_cache = QueryCache(maxsize=10_000, ttl=3600)
+
+# Router intents for near-duplicate queries: keyed by query embedding
+semantic_intent_cache = SemanticCache(maxsize=1024, threshold=0.92)
+
+# Generated SQL: keyed by normalized (enhanced) query + schema + context
+sql_cache = QueryCache(maxsize=10_000, ttl=3600)
+
+# Query results: keyed by SQL text, short TTL since the data can change
+results_cache = QueryCache(maxsize=1_000, ttl=60)
+
+# Visualization configs: keyed by normalized query + result column names/types
+viz_cache = QueryCache(maxsize=1_000, ttl=3600)
+
+# Parsed tool requests ({"tool": ..., "parameters": ...}): keyed by normalized query
+tool_cache = QueryCache(maxsize=1_000, ttl=3600)
+
+# Insight text: keyed by normalized query + digest of the result sample
+insights_cache = QueryCache(maxsize=1_000, ttl=3600)
+
+# Insights for near-duplicate queries: keyed by query embedding, storing
+# (result digest, insight text) so a hit is only used for the same results
+semantic_insights_cache = SemanticCache(maxsize=1024, threshold=0.92)
+
+# Wikipedia summaries (or a not-found marker): keyed by lowercased topic. Kept a day,
+# since articles change slowly and misses would otherwise be retried with backoff
+wiki_cache = QueryCache(maxsize=2048, ttl=86400)
+
+# Query embeddings (float32 arrays): keyed by embedding model + lowercased text. Not
+# cleared with the query caches, since embeddings don't depend on the schema or data
+embedding_cache = QueryCache(maxsize=4096, ttl=3600)
+
+
+def clear_query_caches() -> None:
+    """Invalidate every LLM/query cache (e.g. after a schema refresh)."""
+    intent_cache.clear()
+    semantic_intent_cache.clear()
+    sql_cache.clear()
+    results_cache.clear()
+    viz_cache.clear()
+    tool_cache.clear()
+    insights_cache.clear()
+    semantic_insights_cache.clear()
@@ -1,27 +1,107 @@
 import asyncpg
+import asyncio
+import functools
+import hashlib
 import os
+import time
+from dataclasses import dataclass, asdict
 from dotenv import load_dotenv
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
-# Load environment variables from .env file
-load_dotenv()
+__all__ = [
+    "DBConfig",
+    "get_pool",
+    "close_pool",
+    "pool_stats",
+    "fetch_schema",
+    "fetch_schema_tables",
+    "get_schema_fingerprint",
+    "invalidate_schema_cache",
+    "execute_query",
+    "execute_query_columnar",
+]
 
 # Create connection pool
 _pool: asyncpg.Pool = None
 
+# Schema cache: (timestamp, formatted schema string) and the grouped tables dict.
+# The schema is near-static, so it is rebuilt at most once per TTL window.
+_SCHEMA_TTL = 300  # seconds
+_SCHEMA_CACHE: Optional[Tuple[float, str]] = None
+_SCHEMA_TABLES_CACHE: Optional[Dict[str, List[Dict[str, Any]]]] = None
+_SCHEMA_FINGERPRINT: Optional[str] = None
+_schema_lock = asyncio.Lock()
 
-def _get_db_config():
-    """Get database configuration from environment variables."""
-    DB_HOST = os.getenv('DB_HOST', 'localhost')
-    DB_PORT = int(os.getenv('DB_PORT', 5432))
+# Per-transaction settings for user-facing queries
+STATEMENT_TIMEOUT = '5s'
+QUERY_WORK_MEM = '64MB'
+
+_SCHEMA_QUERY = """
+    SELECT 
+        table_name,
+        column_name,
+        data_type,
+        is_nullable,
+        character_maximum_length
+    FROM information_schema.columns
+    WHERE table_schema = 'public'
+    ORDER BY table_name, ordinal_position;
+"""
+
+
+@dataclass(frozen=True)
+class DBConfig:
+    """Connection settings passed straight to asyncpg.create_pool."""
+    host: str
+    port: int
+    database: str
+    user: str
+    password: str
+    min_size: int
+    max_size: int
+
+
+@functools.lru_cache(maxsize=1)
+def _get_db_config() -> DBConfig:
+    """
+    Get database configuration from environment variables.
+    Loaded once on first use, so importing this module has no side effects.
+    """
+    # Load environment variables from .env file
+    load_dotenv()
+    
     DB_NAME = os.getenv('DB_NAME')
-    DB_USER = os.getenv('DB_USER', 'postgres')
     DB_PASSWORD = os.getenv('DB_PASSWORD')
     
     if not DB_NAME or not DB_PASSWORD:
         raise ValueError("DB_NAME and DB_PASSWORD must be set in .env file")
     
-    return DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+    return DBConfig(
+        host=os.getenv('DB_HOST', 'localhost'),
+        port=int(os.getenv('DB_PORT', 5432)),
+        database=DB_NAME,
+        user=os.getenv('DB_USER', 'postgres'),
+        password=DB_PASSWORD,
+        # Pool sizing, overridable for the deployment's concurrency
+        min_size=int(os.getenv('DB_POOL_MIN', 4)),
+        max_size=int(os.getenv('DB_POOL_MAX', 32))
+    )
+
+
+async def _init_connection(connection: asyncpg.Connection):
+    """
+    Configure each new pooled connection.
+    
+    NUMERIC values are decoded straight to float by the driver so results are
+    JSON-ready without a per-row Python conversion pass.
+    """
+    await connection.set_type_codec(
+        'numeric',
+        encoder=str,
+        decoder=float,
+        schema='pg_catalog',
+        format='text'
+    )
 
 
 async def get_pool() -> asyncpg.Pool:
@@ -29,20 +109,42 @@ async def get_pool() -> asyncpg.Pool:
     global _pool
     if _pool is None:
         # Get database config (will raise error if not set)
-        DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD = _get_db_config()
+        config = _get_db_config()
         
         _pool = await asyncpg.create_pool(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            min_size=1,
-            max_size=10
+            **asdict(config),
+            max_inactive_connection_lifetime=300,
+            command_timeout=30,
+            # Per-connection LRU of prepared statements used by fetch()/execute() with
+            # args; the parameterized agent queries are planned once per connection
+            statement_cache_size=1024,
+            # JIT compilation costs more than it saves on short, varied generated queries
+            server_settings={'application_name': 'querymind', 'jit': 'off'},
+            init=_init_connection
         )
     return _pool
 
 
+def pool_stats() -> Dict[str, int]:
+    """
+    Return current pool size figures for tuning min/max sizing. The keys are the same
+    before the pool exists, with the configured bounds (or 0 if unconfigured).
+    """
+    if _pool is None:
+        try:
+            config = _get_db_config()
+            min_size, max_size = config.min_size, config.max_size
+        except ValueError:
+            min_size = max_size = 0
+        return {"size": 0, "idle": 0, "min_size": min_size, "max_size": max_size}
+    return {
+        "size": _pool.get_size(),
+        "idle": _pool.get_idle_size(),
+        "min_size": _pool.get_min_size(),
+        "max_size": _pool.get_max_size()
+    }
+
+
 async def close_pool():
     """Close the database connection pool."""
     global _pool
@@ -51,31 +153,68 @@ async def close_pool():
         _pool = None
 
 
+def invalidate_schema_cache():
+    """Drop the cached schema so the next fetch_schema() call re-reads information_schema."""
+    global _SCHEMA_CACHE, _SCHEMA_TABLES_CACHE, _SCHEMA_FINGERPRINT
+    _SCHEMA_CACHE = None
+    _SCHEMA_TABLES_CACHE = None
+    _SCHEMA_FINGERPRINT = None
+
+
+def _schema_cache_fresh() -> bool:
+    """Return True if the cached schema exists and is within its TTL."""
+    return _SCHEMA_CACHE is not None and time.monotonic() - _SCHEMA_CACHE[0] < _SCHEMA_TTL
+
+
 async def fetch_schema() -> str:
+    """
+    Return the formatted database schema for AI prompts, served from an in-process
+    cache for up to _SCHEMA_TTL seconds. Concurrent misses share a single rebuild.
+    """
+    if _schema_cache_fresh():
+        return _SCHEMA_CACHE[1]
+    
+    async with _schema_lock:
+        # Another request may have rebuilt the cache while we waited on the lock
+        if _schema_cache_fresh():
+            return _SCHEMA_CACHE[1]
+        return await _build_schema()
+
+
+async def fetch_schema_tables() -> Dict[str, List[Dict[str, Any]]]:
+    """Return the cached schema grouped by table name (column dicts per table)."""
+    await fetch_schema()
+    return _SCHEMA_TABLES_CACHE or {}
+
+
+def get_schema_fingerprint() -> str:
+    """
+    Return a short blake2b digest of the cached schema's (table, column, type)
+    tuples, or "" if the schema has not been loaded. Changes whenever the DDL does.
+    """
+    return _SCHEMA_FINGERPRINT or ""
+
+
+async def _build_schema() -> str:
     """
     Query information_schema.columns to get table names, column names, and data types
     for all 'public' schema tables. Returns a clean, readable string formatted for AI prompts.
     """
+    global _SCHEMA_CACHE, _SCHEMA_TABLES_CACHE, _SCHEMA_FINGERPRINT
     pool = await get_pool()
     
-    query = """
-        SELECT 
-            table_name,
-            column_name,
-            data_type,
-            is_nullable,
-            character_maximum_length
-        FROM information_schema.columns
-        WHERE table_schema = 'public'
-        ORDER BY table_name, ordinal_position;
-    """
-    
-    rows = await pool.fetch(query)
+    async with pool.acquire() as connection:
+        # fetch() goes through the connection's statement cache, so a rebuild on a
+        # connection that has run this before skips Parse/plan on the server
+        # (an explicit prepare() bypasses that cache)
+        rows = await connection.fetch(_SCHEMA_QUERY)
     
-    # Group by table name
+    # Group by table name, fingerprinting (table, column, type) as we go
     tables = {}
+    fingerprint = hashlib.blake2b(digest_size=16)
     for row in rows:
         table_name = row['table_name']
+        fingerprint.update(f"{table_name}\x00{row['column_name']}\x00{row['data_type']}\x00".encode())
         if table_name not in tables:
             tables[table_name] = []
         
@@ -87,50 +226,70 @@ async def fetch_schema() -> str:
         }
         tables[table_name].append(col_info)
     
-    # Format as readable string
-    schema_str = "Database Schema:\n\n"
+    # Format as readable string (collect fragments and join once)
+    parts: List[str] = ["Database Schema:\n\n"]
     for table_name, columns in sorted(tables.items()):
-        schema_str += f"Table: {table_name}\n"
-        schema_str += "-" * (len(table_name) + 7) + "\n"
+        header = f"Table: {table_name}"
+        parts.append(f"{header}\n{'-' * len(header)}\n")
         for col in columns:
             type_str = col['type']
             if col['max_length']:
                 type_str += f"({col['max_length']})"
             nullable_str = "NULL" if col['nullable'] else "NOT NULL"
-            schema_str += f"  - {col['name']}: {type_str} {nullable_str}\n"
-        schema_str += "\n"
+            parts.append(f"  - {col['name']}: {type_str} {nullable_str}\n")
+        parts.append("\n")
+    schema_str = "".join(parts)
     
+    _SCHEMA_TABLES_CACHE = tables
+    _SCHEMA_FINGERPRINT = fingerprint.hexdigest()
+    _SCHEMA_CACHE = (time.monotonic(), schema_str)
     return schema_str
 
 
-async def execute_query(sql_query: str) -> List[Dict[str, Any]]:
+async def _apply_query_limits(connection: asyncpg.Connection) -> None:
+    """
+    Cap runaway generated queries and give sorts/hashes room. Must run inside a
+    transaction: SET LOCAL resets when it ends.
+    """
+    await connection.execute(
+        f"SET LOCAL statement_timeout = '{STATEMENT_TIMEOUT}'; "
+        f"SET LOCAL work_mem = '{QUERY_WORK_MEM}'"
+    )
+
+
+async def execute_query(sql_query: str, *args) -> List[Dict[str, Any]]:
     """
     Execute a read-only SQL query using asyncpg pool and return results as a list of dictionaries.
-    Converts Decimal types to float for JSON serialization.
+    Positional args are bound to $1, $2, ... placeholders in the query.
+    The query runs in a READ ONLY transaction, so generated SQL cannot modify data.
+    NUMERIC columns arrive as float (see _init_connection); datetime values are left
+    as-is and serialized by orjson at the response boundary.
     """
-    from decimal import Decimal
-    import datetime
+    pool = await get_pool()
     
+    async with pool.acquire() as connection:
+        async with connection.transaction(readonly=True, isolation='repeatable_read'):
+            await _apply_query_limits(connection)
+            rows = await connection.fetch(sql_query, *args)
+        return [dict(row) for row in rows]
+
+
+async def execute_query_columnar(sql_query: str, *args) -> Dict[str, List[Any]]:
+    """
+    Execute a read-only SQL query like execute_query (same READ ONLY transaction,
+    statement_timeout and work_mem), but return results column-wise as
+    {column_name: [values...]}, skipping the per-row dict allocation.
+    Suited to large results that are plotted or exported by column.
+    """
     pool = await get_pool()
     
     async with pool.acquire() as connection:
-        rows = await connection.fetch(sql_query)
-        
-        # Convert rows to list of dictionaries
-        results = []
-        for row in rows:
-            row_dict = {}
-            for key, value in dict(row).items():
-                # Convert Decimal to float for JSON serialization
-                if isinstance(value, Decimal):
-                    row_dict[key] = float(value)
-                # Convert datetime objects to ISO format strings
-                elif isinstance(value, (datetime.datetime, datetime.date)):
-                    row_dict[key] = value.isoformat()
-                # Keep other types as-is
-                else:
-                    row_dict[key] = value
-            results.append(row_dict)
-        
-        return results
+        async with connection.transaction(readonly=True, isolation='repeatable_read'):
+            await _apply_query_limits(connection)
+            stmt = await connection.prepare(sql_query)
+            columns = [attr.name for attr in stmt.get_attributes()]
+            rows = await stmt.fetch(*args)
+    if not rows:
+        return {name: [] for name in columns}
+    return {name: list(values) for name, values in zip(columns, zip(*rows))}
 
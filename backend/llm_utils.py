@@ -0,0 +1,107 @@
+import asyncio
+import functools
+import logging
+import re
+from typing import Any, Dict, Optional
+
+import google.generativeai as genai
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Matches a whole response wrapped in a markdown code fence (any language tag), capturing the body
+_FENCE_RE = re.compile(r"^\s*```[\w+-]*\s*\n?(.*?)\n?```\s*$", re.DOTALL)
+
+
+def strip_fence(text: str) -> str:
+    """Remove a surrounding markdown code fence from an LLM response, if present."""
+    match = _FENCE_RE.match(text)
+    return match.group(1).strip() if match else text.strip()
+
+
+@functools.lru_cache(maxsize=None)
+def _json_generation_config(schema: type, max_output_tokens: Optional[int]) -> Dict[str, Any]:
+    """
+    Build (once per schema and cap) the generation config that puts Gemini in JSON mode.
+    Temperature 0 keeps classifications deterministic, so cached answers stay valid.
+    """
+    config = {"response_mime_type": "application/json", "response_schema": schema, "temperature": 0.0}
+    if max_output_tokens is not None:
+        config["max_output_tokens"] = max_output_tokens
+    return config
+
+
+async def llm_json(
+    model: genai.GenerativeModel,
+    prompt: str,
+    schema: type,
+    fallback: Optional[Dict[str, Any]] = None,
+    timeout: float = 6.0,
+    max_output_tokens: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Ask Gemini for a JSON object matching a response schema.
+
+    Args:
+        model: The Gemini model to call
+        prompt: The full prompt text
+        schema: A TypedDict describing the expected object
+        fallback: Returned when the call times out, fails, or returns invalid JSON
+        timeout: Upper bound on the call in seconds
+        max_output_tokens: Cap on generated tokens (model default if None)
+
+    Returns:
+        The parsed object, or fallback on any error
+    """
+    try:
+        response = await asyncio.wait_for(
+            model.generate_content_async(prompt, generation_config=_json_generation_config(schema, max_output_tokens)),
+            timeout
+        )
+        parsed = orjson.loads(response.text)
+        if isinstance(parsed, dict):
+            return parsed
+        logger.warning("Gemini returned %s instead of a JSON object for %s", type(parsed).__name__, schema.__name__)
+    except asyncio.TimeoutError:
+        logger.warning("Gemini call for %s timed out after %ss", schema.__name__, timeout)
+    except orjson.JSONDecodeError as e:
+        logger.warning("Gemini returned invalid JSON for %s: %s", schema.__name__, e)
+    except Exception as e:
+        logger.warning("Gemini call for %s failed: %s", schema.__name__, e, exc_info=True)
+    return fallback
+
+
+async def llm_text(
+    model: genai.GenerativeModel,
+    prompt: str,
+    generation_config: Optional[Dict[str, Any]] = None,
+    timeout: float = 6.0,
+    stream: bool = False
+) -> str:
+    """
+    Ask Gemini for plain text, stripped of whitespace and any surrounding code fence.
+
+    Args:
+        model: The Gemini model to call
+        prompt: The full prompt text
+        generation_config: Per-call generation settings (model defaults if None)
+        timeout: Upper bound on the call in seconds
+        stream: Consume the response as chunks while Gemini decodes it
+
+    Returns:
+        The cleaned response text (may be empty)
+
+    Raises:
+        asyncio.TimeoutError and any Gemini error; callers choose their own fallback
+    """
+    async def generate() -> str:
+        if not stream:
+            response = await model.generate_content_async(prompt, generation_config=generation_config)
+            return response.text
+        response = await model.generate_content_async(prompt, generation_config=generation_config, stream=True)
+        chunks = []
+        async for chunk in response:
+            chunks.append(chunk.text)
+        return "".join(chunks)
+
+    return strip_fence(await asyncio.wait_for(generate(), timeout))
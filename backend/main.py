@@ -1,13 +1,24 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from backend.orchestrator import app as workflow_app
+from backend.orchestrator import app as workflow_app, _safeguard_sql, classify_queries
 from backend.memory import MemoryManager
 from backend.tools import translate_to_english
+from backend.database import fetch_schema, invalidate_schema_cache, close_pool, pool_stats, execute_query_columnar
+from backend.cache import clear_query_caches
+from backend.vector_store import warm_collection, close_openai_client
+from logging.handlers import QueueHandler, QueueListener
 import asyncio
-import traceback
+import logging
+import orjson
+import os
+import queue
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+# orjson serializes datetime/date natively in C, so query results need no pre-conversion
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -29,11 +40,124 @@ def get_memory_manager():
             memory_manager = MemoryManager()
         except ValueError as e:
             # If API key is not set, return None (memory features will be disabled)
-            print(f"Warning: Memory manager not available: {e}")
+            logger.warning("Memory manager not available: %s", e)
             return None
     return memory_manager
 
 
+# Bounded queue for fire-and-forget memory writes, drained by a fixed set of workers
+MEMORY_QUEUE_SIZE = 1024
+MEMORY_WORKERS = 4
+_memory_queue: asyncio.Queue = None
+_background_tasks = []
+
+
+async def _memory_worker():
+    """Store queued exchanges one at a time until cancelled."""
+    while True:
+        mem_manager, item = await _memory_queue.get()
+        try:
+            await mem_manager.store_exchange(**item)
+        except Exception as e:
+            logger.warning("Storing exchange failed: %s", e, exc_info=True)
+        finally:
+            _memory_queue.task_done()
+
+
+def _enqueue_exchange(mem_manager, **item):
+    """Queue an exchange for storage, dropping it if the queue is full."""
+    try:
+        _memory_queue.put_nowait((mem_manager, item))
+    except asyncio.QueueFull:
+        logger.warning("Memory store queue is full, dropping exchange")
+
+
+# Log records are queued by the request path and written to stderr by a listener thread
+_log_listener: QueueListener = None
+
+
+def _start_log_listener():
+    """Route root-logger records through a queue so handler I/O stays off the event loop."""
+    global _log_listener
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    _log_listener = QueueListener(log_queue, stream_handler)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(QueueHandler(log_queue))
+    # LOG_LEVEL (e.g. WARNING to quiet startup/info messages); defaults to INFO
+    root_logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    _log_listener.start()
+
+
+async def _warm_schema_cache():
+    """Load the schema into its cache so the first analytical query skips the DB round-trip."""
+    try:
+        await fetch_schema()
+    except Exception as e:
+        logger.warning("Schema warm-up failed: %s", e)
+
+
+async def _warm_vector_store():
+    """Open the Chroma collection off the event loop so the first semantic search skips the load."""
+    try:
+        count = await asyncio.to_thread(warm_collection)
+        logger.info("Vector store ready: %s products", count)
+    except Exception as e:
+        logger.warning("Vector store warm-up failed: %s", e)
+
+
+def _read_warmup_queries(path: str) -> list:
+    """Read one query per line, skipping blanks."""
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+async def _warm_intent_cache():
+    """
+    Pre-classify common queries listed one per line in ROUTER_WARMUP_FILE (e.g. exported
+    from logged traffic) with the batch classifier, so they hit the intent cache.
+    """
+    path = os.getenv("ROUTER_WARMUP_FILE")
+    if not path:
+        return
+    try:
+        queries = await asyncio.to_thread(_read_warmup_queries, path)
+        await classify_queries(queries)
+        logger.info("Intent cache warmed with %s queries", len(queries))
+    except Exception as e:
+        logger.warning("Intent cache warm-up failed: %s", e)
+
+
+@app.on_event("startup")
+async def startup():
+    """Start logging, the background memory-store workers, and warm the schema, vector store and intent cache."""
+    global _memory_queue
+    _start_log_listener()
+    _memory_queue = asyncio.Queue(maxsize=MEMORY_QUEUE_SIZE)
+    for _ in range(MEMORY_WORKERS):
+        _background_tasks.append(asyncio.create_task(_memory_worker()))
+    # Runs in the background so startup isn't blocked on the database
+    _background_tasks.append(asyncio.create_task(_warm_schema_cache()))
+    _background_tasks.append(asyncio.create_task(_warm_vector_store()))
+    _background_tasks.append(asyncio.create_task(_warm_intent_cache()))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Stop background workers and release shared clients when the server stops."""
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    if memory_manager is not None:
+        await memory_manager.aclose()
+    await close_pool()
+    await close_openai_client()
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
 class ChatRequest(BaseModel):
     message: str
     conversation_id: str
@@ -44,95 +168,158 @@ class TranslateRequest(BaseModel):
     text: str
 
 
+class ColumnarQueryRequest(BaseModel):
+    sql_query: str
+
+
+async def _build_initial_state(request: ChatRequest, mem_manager) -> dict:
+    """Fetch memory context and build the initial LangGraph state for a request."""
+    # Get memory context before calling the LangGraph app
+    memory_context = {}
+    if mem_manager:
+        try:
+            memory_context = await mem_manager.get_context(
+                user_id=request.user_id,
+                conversation_id=request.conversation_id
+            )
+        except Exception as e:
+            logger.warning("Getting memory context failed: %s", e, exc_info=True)
+            memory_context = {}
+    
+    # Create initial state with memory context
+    return {
+        "query": request.message,
+        "intent": "",
+        "sql_query": None,
+        "results": None,
+        "visualization_config": None,
+        "memory_context": memory_context,
+        "db_schema": "",
+        "error": None,
+        "insights": None
+    }
+
+
+def _finalize_state(request: ChatRequest, final_state: dict, mem_manager) -> dict:
+    """Add the user-facing message to the final state and store the exchange in memory."""
+    # Ensure results is always an array (never None)
+    if final_state.get('results') is None:
+        final_state['results'] = []
+    
+    # Generate a user-friendly message based on the state
+    message = "Here's what I found."
+    if final_state.get('error'):
+        message = f"Error: {final_state['error']}"
+    elif not final_state.get('results') or len(final_state['results']) == 0:
+        if final_state.get('intent') == 'conversational':
+            message = "I'm here to help! Ask me about products, sales, or anything related to the e-commerce database."
+        else:
+            message = "No results found for your query. Please try rephrasing your question."
+    elif final_state.get('intent') == 'analytical' and final_state.get('sql_query'):
+        message = f"Found {len(final_state['results'])} results for your query."
+    elif final_state.get('intent') == 'semantic':
+        message = f"Found {len(final_state['results'])} products matching your query."
+    elif final_state.get('intent') == 'tool':
+        message = "Here's the information you requested."
+    
+    # Add message to final state
+    final_state['message'] = message
+    
+    # Queue the exchange for background storage if memory manager is available
+    if mem_manager:
+        # Store a compact projection rather than the full state (schema, all rows)
+        memory_payload = {
+            "message": final_state["message"],
+            "intent": final_state.get("intent"),
+            "sql_query": final_state.get("sql_query"),
+            "row_count": len(final_state.get("results") or [])
+        }
+        _enqueue_exchange(
+            mem_manager,
+            user_id=request.user_id,
+            conversation_id=request.conversation_id,
+            query=request.message,
+            response=orjson.dumps(memory_payload).decode()
+        )
+    
+    return final_state
+
+
+# Result sets above this size are serialized in a worker thread so the event loop
+# keeps serving other requests while a large response is encoded
+LARGE_RESULT_ROWS = 1000
+
+
+async def _dump_state(state: dict) -> bytes:
+    """Serialize a final state to JSON bytes, off the event loop for large result sets."""
+    if len(state.get('results') or []) > LARGE_RESULT_ROWS:
+        return await asyncio.to_thread(orjson.dumps, state, default=str)
+    return orjson.dumps(state, default=str)
+
+
+def _error_response(request: ChatRequest, e: Exception) -> dict:
+    """Build an error response with the same structure as a successful one."""
+    return {
+        "query": request.message,
+        "intent": "",
+        "sql_query": None,
+        "results": [],  # Always return an array
+        "visualization_config": None,
+        "memory_context": {},
+        "db_schema": "",
+        "error": str(e),
+        "message": f"Error processing your query: {str(e)}"
+    }
+
+
 @app.post("/api/chat/query")
 async def chat_query(request: ChatRequest):
     try:
         # Get memory manager (returns None if not configured)
         mem_manager = get_memory_manager()
         
-        # Get memory context before calling the LangGraph app
-        memory_context = {}
-        if mem_manager:
-            try:
-                memory_context = await mem_manager.get_context(
-                    user_id=request.user_id,
-                    conversation_id=request.conversation_id
-                )
-            except Exception as e:
-                print(f"Error getting memory context: {e}")
-                memory_context = {}
-        
-        # Create initial state with memory context
-        initial_state = {
-            "query": request.message,
-            "intent": "",
-            "sql_query": None,
-            "results": None,
-            "visualization_config": None,
-            "memory_context": memory_context,
-            "db_schema": "",
-            "error": None,
-            "insights": None
-        }
+        initial_state = await _build_initial_state(request, mem_manager)
         
         # Invoke the workflow
         final_state = await workflow_app.ainvoke(initial_state)
         
-        # Ensure results is always an array (never None)
-        if final_state.get('results') is None:
-            final_state['results'] = []
-        
-        # Generate a user-friendly message based on the state
-        message = "Here's what I found."
-        if final_state.get('error'):
-            message = f"Error: {final_state['error']}"
-        elif not final_state.get('results') or len(final_state['results']) == 0:
-            if final_state.get('intent') == 'conversational':
-                message = "I'm here to help! Ask me about products, sales, or anything related to the e-commerce database."
-            else:
-                message = "No results found for your query. Please try rephrasing your question."
-        elif final_state.get('intent') == 'analytical' and final_state.get('sql_query'):
-            message = f"Found {len(final_state['results'])} results for your query."
-        elif final_state.get('intent') == 'semantic':
-            message = f"Found {len(final_state['results'])} products matching your query."
-        elif final_state.get('intent') == 'tool':
-            message = "Here's the information you requested."
-        
-        # Add message to final state
-        final_state['message'] = message
-        
-        # Store the exchange asynchronously (fire and forget) if memory manager is available
-        if mem_manager:
-            asyncio.create_task(
-                mem_manager.store_exchange(
-                    user_id=request.user_id,
-                    conversation_id=request.conversation_id,
-                    query=request.message,
-                    response=str(final_state)  # Convert final_state to string representation
-                )
-            )
-        
         # Return the final state
-        return final_state
+        final_state = _finalize_state(request, final_state, mem_manager)
+        return Response(content=await _dump_state(final_state), media_type="application/json")
     except Exception as e:
         # Log the full error for debugging
-        error_trace = traceback.format_exc()
-        print(f"Error in chat_query: {error_trace}")
+        logger.warning("chat_query failed: %s", e, exc_info=True)
         
         # Return a proper error response with consistent structure
-        error_response = {
-            "query": request.message,
-            "intent": "",
-            "sql_query": None,
-            "results": [],  # Always return an array
-            "visualization_config": None,
-            "memory_context": {},
-            "db_schema": "",
-            "error": str(e),
-            "message": f"Error processing your query: {str(e)}"
-        }
-        
-        return error_response
+        return _error_response(request, e)
+
+
+@app.post("/api/chat/query/stream")
+async def chat_query_stream(request: ChatRequest):
+    """
+    Streaming variant of /api/chat/query. Emits newline-delimited JSON: one
+    {"status": <node>} line as each workflow step completes, then the final state,
+    so clients get a first byte long before the presenter step finishes.
+    """
+    async def event_stream():
+        try:
+            mem_manager = get_memory_manager()
+            initial_state = await _build_initial_state(request, mem_manager)
+            
+            final_state = initial_state
+            async for update in workflow_app.astream(initial_state):
+                # Every node returns the full state, so the latest update is the current state
+                for node_name, node_state in update.items():
+                    yield orjson.dumps({"status": node_name}) + b"\n"
+                    final_state = node_state
+            
+            final_state = _finalize_state(request, final_state, mem_manager)
+            yield await _dump_state(final_state) + b"\n"
+        except Exception as e:
+            logger.warning("chat_query_stream failed: %s", e, exc_info=True)
+            yield orjson.dumps(_error_response(request, e)) + b"\n"
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
 
 
 @app.post("/api/translate")
@@ -144,7 +331,64 @@ async def translate_text(request: TranslateRequest):
         translated_text = await translate_to_english(request.text)
         return {"translated": translated_text}
     except Exception as e:
-        error_trace = traceback.format_exc()
-        print(f"Error in translate_text: {error_trace}")
+        logger.warning("translate_text failed: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error translating text: {str(e)}")
 
+
+@app.post("/api/query/columnar")
+async def query_columnar(request: ColumnarQueryRequest):
+    """
+    Re-run the SQL of an analytical answer (its sql_query field) and return the results
+    column-wise, e.g. for charting or exporting a large result set without a JSON object
+    per row. The SQL is screened like generated SQL and runs in a READ ONLY transaction.
+    """
+    try:
+        sql_query = _safeguard_sql(request.sql_query)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        columns = await execute_query_columnar(sql_query)
+    except Exception as e:
+        logger.warning("query_columnar failed: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error executing query: {str(e)}")
+    
+    return Response(
+        content=await asyncio.to_thread(orjson.dumps, {"columns": columns}, default=str),
+        media_type="application/json"
+    )
+
+
+@app.post("/api/admin/schema/refresh")
+async def refresh_schema():
+    """
+    Invalidate the cached database schema so the next analytical query re-reads it.
+    Cached intents, SQL, and results are dropped too since they depend on the schema.
+    """
+    invalidate_schema_cache()
+    clear_query_caches()
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Report database pool usage so DB_POOL_MIN/DB_POOL_MAX can be tuned.
+    """
+    return {"db_pool": pool_stats()}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    
+    # uvloop + httptools (both shipped with uvicorn[standard]) for the async hot path.
+    # Each worker has its own DB pool: keep WEB_CONCURRENCY x DB_POOL_MAX below
+    # Postgres' max_connections (see README)
+    uvicorn.run(
+        "backend.main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
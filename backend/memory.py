@@ -1,8 +1,11 @@
+import logging
 import os
 from dotenv import load_dotenv
 from supermemory import AsyncSupermemory
 from typing import Dict, Any
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
@@ -17,6 +20,13 @@ class MemoryManager:
         self.api_key = os.getenv('SUPERMEMORY_API_KEY')
         if not self.api_key:
             raise ValueError("SUPERMEMORY_API_KEY must be set in .env file")
+        
+        # One shared client so keep-alive connections are reused across calls
+        self.client = AsyncSupermemory(api_key=self.api_key)
+    
+    async def aclose(self) -> None:
+        """Close the shared Supermemory client."""
+        await self.client.close()
     
     async def get_context(self, user_id: str, conversation_id: str) -> Dict[str, Any]:
         """
@@ -29,10 +39,9 @@ class MemoryManager:
         Returns:
             Dictionary containing the conversation context
         """
-        client = AsyncSupermemory(api_key=self.api_key)
         try:
             # Call get_context on the client (using memories.get() as per the API)
-            response = await client.memories.get(
+            response = await self.client.memories.get(
                 user_id=user_id,
                 conversation_id=conversation_id
             )
@@ -49,10 +58,8 @@ class MemoryManager:
                     return response.model_dump()
                 return {}
         except Exception as e:
-            print(f"Error getting context: {e}")
+            logger.warning("Getting memory context failed: %s", e, exc_info=True)
             return {}
-        finally:
-            await client.close()
     
     async def store_exchange(
         self, 
@@ -72,10 +79,9 @@ class MemoryManager:
             response: The system's response
             **kwargs: Additional parameters for add_memory
         """
-        client = AsyncSupermemory(api_key=self.api_key)
         try:
             # Call add_memory on the client (using memories.add() if that's the actual API)
-            await client.memories.add(
+            await self.client.memories.add(
                 user_id=user_id,
                 conversation_id=conversation_id,
                 message=query,
@@ -83,7 +89,5 @@ class MemoryManager:
                 **kwargs
             )
         except Exception as e:
-            print(f"Error storing exchange: {e}")
-        finally:
-            await client.close()
+            logger.warning("Storing exchange failed: %s", e, exc_info=True)
 
@@ -1,12 +1,26 @@
-from typing import TypedDict, Optional, List, Literal
+from typing import Any, TypedDict, Optional, List, Literal
 from langgraph.graph import StateGraph, END
+import asyncio
+import datetime
+import functools
+import logging
+import time
 import os
-import json
+import orjson
+import re
 from dotenv import load_dotenv
 import google.generativeai as genai
-from backend.database import fetch_schema, execute_query
-from backend.vector_store import semantic_search
+from google.generativeai import caching
+from backend.database import fetch_schema, execute_query, get_schema_fingerprint, get_pool
+from backend.vector_store import semantic_search, embed_query
 from backend.tools import wikipedia_lookup, get_definition
+from backend.llm_utils import llm_json, llm_text
+from backend.cache import (
+    intent_cache, semantic_intent_cache, sql_cache, results_cache, viz_cache, tool_cache,
+    insights_cache, semantic_insights_cache, normalize_query, make_key, SemanticCache
+)
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
@@ -18,131 +32,205 @@ if not GEMINI_API_KEY:
 
 genai.configure(api_key=GEMINI_API_KEY)
 
-
-class QueryState(TypedDict):
-    query: str
-    intent: str
-    sql_query: Optional[str]
-    results: Optional[List[dict]]
-    visualization_config: Optional[dict]
-    memory_context: dict
-    db_schema: str
-    error: Optional[str]
-    insights: Optional[str]
-
-
-async def enhance_query_with_context(query: str, memory_context: dict) -> str:
+# Shared Gemini model (constructed once, reused by every agent)
+gemini_model = genai.GenerativeModel('gemini-2.5-flash')
+
+# Upper bounds (seconds) on a single Gemini call so a degraded provider can't stall
+# requests indefinitely: short JSON/text calls, SQL generation, and insights
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', 6))
+GEMINI_SQL_TIMEOUT = float(os.getenv('GEMINI_SQL_TIMEOUT', 20))
+GEMINI_INSIGHTS_TIMEOUT = float(os.getenv('GEMINI_INSIGHTS_TIMEOUT', 20))
+# Time the insights agent waits on the query embedding for its semantic cache lookup
+INSIGHTS_EMBEDDING_TIMEOUT = 1.0
+
+# Output caps per call type, all at temperature 0. gemini-2.5-flash counts its thinking
+# tokens against max_output_tokens, so the caps leave headroom above the visible answer
+# (an intent, tool request or viz config is well under 100 tokens).
+JSON_MAX_OUTPUT_TOKENS = 1024
+ROUTER_BATCH_MAX_OUTPUT_TOKENS = 8192
+ENHANCE_GENERATION_CONFIG = {'temperature': 0.0, 'max_output_tokens': 1024}
+SQL_GENERATION_CONFIG = {'temperature': 0.0, 'max_output_tokens': 4096}
+
+
+# Explicit Gemini context cache holding the schema + SQL rules for analytical_agent,
+# rebuilt when the schema fingerprint changes or shortly before the cache expires
+SQL_CONTEXT_CACHE_TTL = 3600  # seconds
+# After a failed create, requests use the full prompt for this long before retrying
+SQL_CONTEXT_CACHE_RETRY = 60  # seconds
+# (schema fingerprint, expires_at, model or None, CachedContent or None)
+_sql_model_entry: Optional[tuple] = None
+_sql_model_lock = asyncio.Lock()
+
+
+def _sql_model_entry_fresh(fingerprint: str) -> bool:
+    """Return True if the cached SQL model entry matches the schema and has not expired."""
+    return (
+        _sql_model_entry is not None
+        and _sql_model_entry[0] == fingerprint
+        and time.monotonic() < _sql_model_entry[1]
+    )
+
+
+async def _get_sql_model(sql_context: str) -> Optional[genai.GenerativeModel]:
     """
-    Enhance a user query with conversation context to understand follow-up queries.
-    
-    This function uses Gemini to expand and contextualize queries based on previous
-    conversation history. For example, if a user previously asked about "good reviews"
-    and then says "bad review", it will understand this means "products with bad reviews".
+    Return a model bound to an explicit context cache of the static SQL-generation
+    prompt (schema + rules), so each analytical call only sends the question.
     
     Args:
-        query: The current user query
-        memory_context: Dictionary containing conversation history from Supermemory
-        
+        sql_context: The static prompt text built from the current schema
+    
     Returns:
-        Enhanced query string that includes context from previous conversations
+        The cached-content model, or None if the cache could not be created (the
+        caller then sends the full prompt to the shared model)
     """
-    # If no memory context, return the original query
-    if not memory_context or not isinstance(memory_context, dict):
-        return query
+    global _sql_model_entry
+    fingerprint = get_schema_fingerprint()
+    if _sql_model_entry_fresh(fingerprint):
+        return _sql_model_entry[2]
     
-    # Check if memory_context has any meaningful content
-    # It might be an empty dict or have keys like 'messages', 'context', etc.
-    context_str = json.dumps(memory_context, indent=2)
-    if not context_str or context_str == "{}":
-        return query
-    
-    # Create prompt for Gemini to enhance the query
-    prompt = f"""You are a query enhancement system for a Brazilian e-commerce database.
+    async with _sql_model_lock:
+        if _sql_model_entry_fresh(fingerprint):
+            return _sql_model_entry[2]
+        previous_content = _sql_model_entry[3] if _sql_model_entry is not None else None
+        model = None
+        cached_content = None
+        try:
+            # CachedContent.create is a blocking HTTP call
+            cached_content = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model='models/gemini-2.5-flash',
+                contents=[sql_context],
+                ttl=datetime.timedelta(seconds=SQL_CONTEXT_CACHE_TTL)
+            )
+            model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+            # Renew a minute early so requests never reference an expired cache
+            expires_at = time.monotonic() + SQL_CONTEXT_CACHE_TTL - 60
+        except Exception as e:
+            # E.g. a transient API error, or the prompt is below the minimum cacheable
+            # size; use the full prompt for a short while, then try again
+            logger.warning("Creating SQL context cache failed: %s", e)
+            expires_at = time.monotonic() + SQL_CONTEXT_CACHE_RETRY
+        _sql_model_entry = (fingerprint, expires_at, model, cached_content)
+        
+        if previous_content is not None:
+            # Superseded caches are billed for storage until they expire; delete them
+            task = asyncio.create_task(_delete_cached_content(previous_content))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        return model
+
+
+async def _delete_cached_content(cached_content) -> None:
+    """Delete a superseded context cache once calls that already hold it have finished."""
+    await asyncio.sleep(GEMINI_SQL_TIMEOUT)
+    try:
+        await asyncio.to_thread(cached_content.delete)
+    except Exception as e:
+        logger.warning("Deleting superseded SQL context cache failed: %s", e)
 
-Your task is to expand and contextualize the user's current query based on previous conversation history.
 
-CONVERSATION CONTEXT (from previous messages):
-{context_str}
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks = set()
 
-CURRENT USER QUERY:
-"{query}"
-
-INSTRUCTIONS:
-- If the current query is a follow-up or continuation of a previous query, expand it to include the full context
-- For example, if previous context mentions "products with good reviews" and current query is "bad review", 
-  expand it to "products with bad reviews"
-- If the query is standalone and doesn't reference previous context, return it as-is
-- Preserve the original intent and meaning of the query
-- Make the enhanced query clear and complete for semantic search or SQL generation
-
-Return ONLY the enhanced query string, no explanations, no markdown formatting, no additional text.
-Just return the enhanced query as plain text."""
 
+async def _prefetch_schema():
+    """Warm the schema cache; failures surface later in analytical_agent."""
     try:
-        # Initialize the Gemini model
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        # Generate response
-        response = model.generate_content(prompt)
-        
-        # Extract text from response
-        enhanced_query = response.text.strip()
-        
-        # Remove any markdown code blocks if present
-        if enhanced_query.startswith('```'):
-            # Find the end of the code block marker
-            lines = enhanced_query.split('\n')
-            if lines[0].startswith('```'):
-                lines = lines[1:]
-            if lines and lines[-1].strip() == '```':
-                lines = lines[:-1]
-            enhanced_query = '\n'.join(lines).strip()
-        
-        # If the enhanced query is empty or just whitespace, return original
-        if not enhanced_query:
-            return query
-        
-        print(f"Query enhanced: '{query}' -> '{enhanced_query}'")
-        return enhanced_query
-        
+        await fetch_schema()
     except Exception as e:
-        # On any error, return the original query
-        print(f"Error enhancing query with context: {e}")
-        return query
+        logger.warning("Schema prefetch failed: %s", e)
 
 
-async def router_agent(state: QueryState) -> QueryState:
+# Outer row limit at the end of a statement: LIMIT (optionally followed by OFFSET)
+# or the standard FETCH FIRST/NEXT ... ROWS ONLY
+_TRAILING_LIMIT_RE = re.compile(
+    r"\b(?:LIMIT\s+(?:\d+|ALL)(?:\s+OFFSET\s+\d+)?"
+    r"|FETCH\s+(?:FIRST|NEXT)\s+(?:\d+\s+)?ROWS?\s+(?:ONLY|WITH\s+TIES))\s*$",
+    re.IGNORECASE
+)
+
+# String literals (plain, E'...' with backslash escapes, and $tag$ dollar-quoted) and
+# quoted identifiers, kept as-is; comments; and statement separators
+_SQL_TOKEN_RE = re.compile(
+    r"\b[Ee]'(?:\\.|''|[^'\\])*'|'(?:[^']|'')*'|\$(\w*)\$.*?\$\1\$|\"(?:[^\"]|\"\")*\""
+    r"|--[^\n]*|/\*.*?\*/|;",
+    re.DOTALL
+)
+
+# Row cap applied to generated SQL that has no LIMIT of its own
+MAX_QUERY_ROWS = 10_000
+
+
+def _first_statement(sql: str) -> str:
+    """Return the first non-empty statement in sql with comments removed; quoted text is untouched."""
+    parts = []
+    position = 0
+    for match in _SQL_TOKEN_RE.finditer(sql):
+        token = match.group()
+        parts.append(sql[position:match.start()])
+        position = match.end()
+        if token == ';':
+            statement = "".join(parts).strip()
+            if statement:
+                return statement
+            parts = []
+        elif token.startswith(('--', '/*')):
+            parts.append(' ')
+        else:
+            parts.append(token)
+    parts.append(sql[position:])
+    return "".join(parts).strip()
+
+
+def _safeguard_sql(sql: str, max_rows: int = MAX_QUERY_ROWS) -> str:
     """
-    Router agent that classifies user queries into one of four intents:
-    - analytical: queries requiring SQL execution (e.g., "Top 5", "Total sales", "Average score")
-    - semantic: queries requiring RAG retrieval (e.g., "good products", "bad reviews")
-    - tool: queries requiring external API calls (e.g., "what is 'boleto'?", "translate")
-    - conversational: general conversation queries
+    Cheaply screen LLM-generated SQL before it reaches the database.
+    Strips comments, keeps only the first statement, requires it to be a SELECT
+    (or WITH ... SELECT, possibly parenthesised as in "(SELECT ...) UNION (SELECT ...)"),
+    and appends a LIMIT if the outer query has no LIMIT or FETCH FIRST.
+    Raises ValueError on rejection.
     """
-    query = state.get('query', '')
-    memory_context = state.get('memory_context', {})
-    
-    # Fast path: Check for analytical keywords first (before LLM call)
-    # This ensures queries like "Top 5 highest products" are always classified as analytical
-    query_lower = query.lower()
-    analytical_keywords = [
-        'top', 'highest', 'lowest', 'most', 'least', 'best', 'worst',
-        'count', 'sum', 'average', 'total', 'list', 'show me', 'number of',
-        'how many', 'which', 'what are', 'expensive', 'cheap', 'sellers by',
-        'products by', 'orders by', 'revenue', 'sales'
-    ]
-    
-    # Check if query contains analytical keywords
-    if any(keyword in query_lower for keyword in analytical_keywords):
-        # Additional check: make sure it's not a tool query (definitions, translations)
-        tool_indicators = ['what is', 'what does', 'define', 'meaning of', 'translate']
-        if not any(indicator in query_lower for indicator in tool_indicators):
-            print(f"Fast path: Classifying query as analytical based on keywords: {query}")
-            state['intent'] = 'analytical'
-            return state
-    
-    # Create detailed prompt for intent classification
-    prompt = f"""You are an intent classification system for a Brazilian e-commerce database query system.
+    statement = _first_statement(sql)
+    words = statement.lstrip("( \t\n").split(None, 1)
+    first_word = words[0].upper() if words else ""
+    if first_word not in ("SELECT", "WITH"):
+        raise ValueError(f"Only read-only SELECT queries are allowed, got: {statement[:80]!r}")
+    if not _TRAILING_LIMIT_RE.search(statement):
+        statement = f"{statement}\nLIMIT {max_rows}"
+    return statement
+
+
+# Bounds for the router's view of conversation context: only the most recent list
+# items (e.g. turns) are kept and long strings are truncated
+CONTEXT_MAX_ITEMS = 2
+CONTEXT_MAX_CHARS = 200
+
+
+def _truncate_context(value):
+    """Recursively keep the last CONTEXT_MAX_ITEMS of each list and shorten long strings."""
+    if isinstance(value, str):
+        return value if len(value) <= CONTEXT_MAX_CHARS else value[:CONTEXT_MAX_CHARS] + "..."
+    if isinstance(value, list):
+        return [_truncate_context(item) for item in value[-CONTEXT_MAX_ITEMS:]]
+    if isinstance(value, dict):
+        return {key: _truncate_context(item) for key, item in value.items()}
+    return value
+
+
+def _compact_context(memory_context: dict) -> str:
+    """
+    Render conversation context as compact, key-sorted JSON with bounded size, so the
+    router prompt stays roughly constant as a conversation grows.
+    """
+    if not memory_context:
+        return "No previous conversation context."
+    return orjson.dumps(_truncate_context(memory_context), option=orjson.OPT_SORT_KEYS, default=str).decode()
+
+
+# Static prompt text, built once at import; only the dynamic parts are formatted per request.
+# Static instructions come first and per-request data last, so consecutive calls share an
+# identical prompt prefix that Gemini's implicit context caching can reuse.
+_ROUTER_PROMPT_PREFIX = """You are an intent classification system for a Brazilian e-commerce database query system.
 
 Your task is to classify the user's query into one of four intents based on the query text and conversation context.
 
@@ -201,121 +289,60 @@ INTENT CATEGORIES:
    - "Can you help me?"
    - "What can you do?"
 
-CONVERSATION CONTEXT:
-{json.dumps(memory_context, indent=2) if memory_context else "No previous conversation context."}
-
-USER QUERY:
-"{query}"
-
 INSTRUCTIONS:
 - Analyze the query carefully considering both the query text and conversation context
 - Classify it into exactly one of the four intents: analytical, semantic, tool, or conversational
-- Return ONLY a valid JSON object with this exact structure:
-{{
-  "intent": "analytical" | "semantic" | "tool" | "conversational",
-  "reasoning": "Brief explanation of why this intent was chosen"
-}}
+- Give the intent and a brief reasoning for the choice
 
-Return only the JSON object, no additional text or markdown formatting."""
+"""
 
-    try:
-        # Initialize the Gemini model
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        # Generate response
-        response = model.generate_content(prompt)
-        
-        # Extract text from response
-        response_text = response.text.strip()
-        
-        # Debug: Print raw response
-        print(f"Router agent raw response: {response_text[:500]}")
-        
-        # Remove markdown code blocks if present
-        if response_text.startswith('```json'):
-            response_text = response_text[7:]
-        if response_text.startswith('```'):
-            response_text = response_text[3:]
-        if response_text.endswith('```'):
-            response_text = response_text[:-3]
-        response_text = response_text.strip()
-        
-        # Parse JSON response
-        parsed_response = json.loads(response_text)
-        
-        # Debug: Print parsed intent
-        intent = parsed_response.get('intent', 'conversational')
-        print(f"Router agent classified intent: {intent} for query: {query}")
-        
-        # Update state with the classified intent
-        state['intent'] = intent
-        
-    except json.JSONDecodeError as e:
-        # Fallback to conversational if JSON parsing fails
-        print(f"Error parsing JSON response in router_agent: {e}")
-        try:
-            print(f"Response text was: {response_text[:200]}")
-        except:
-            print("Could not print response text")
-        # If query contains analytical keywords, force analytical intent
-        query_lower = query.lower()
-        analytical_keywords = ['top', 'highest', 'lowest', 'most', 'least', 'best', 'worst', 'count', 'sum', 'average', 'total', 'list', 'show me', 'number of']
-        if any(keyword in query_lower for keyword in analytical_keywords):
-            print(f"Force-setting intent to analytical based on keywords in query: {query}")
-            state['intent'] = 'analytical'
-        else:
-            state['intent'] = 'conversational'
-    except Exception as e:
-        # Fallback to conversational on any error
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Error in router_agent: {error_trace}")
-        # If query contains analytical keywords, force analytical intent
-        query_lower = query.lower()
-        analytical_keywords = ['top', 'highest', 'lowest', 'most', 'least', 'best', 'worst', 'count', 'sum', 'average', 'total', 'list', 'show me', 'number of']
-        if any(keyword in query_lower for keyword in analytical_keywords):
-            print(f"Force-setting intent to analytical based on keywords after error: {query}")
-            state['intent'] = 'analytical'
-        else:
-            state['intent'] = 'conversational'
-    
-    return state
+_VIZ_PROMPT_PREFIX = """You recommend the best visualization for the results of a user's query over a Brazilian e-commerce database.
+
+IMPORTANT GUIDELINES:
+- If the query mentions "ratings", "scores", "bad ratings", "good ratings", or similar, and the data has an "avg_score" or similar numeric column, use a BAR CHART to visualize products by their scores.
+- If the query asks for comparisons, rankings, or "top/best/worst", prefer BAR or LINE charts over tables.
+- Use BAR charts when comparing numeric values across categories (e.g., products by score, products by order count).
+- Use LINE charts only for time-series data or sequential trends.
+- Use TABLE only when the data is primarily text-based (like reviews, descriptions) or when there are too many columns to visualize effectively.
+- For queries about "bad ratings" or "low scores", create a bar chart with product_id or product_category_name_english on x-axis and avg_score on y-axis.
 
+What is the best visualization? Recommend type: 'bar', 'line', 'table', or 'map' and the column names for x_axis, y_axis, and (optionally) color.
 
-async def analytical_agent(state: QueryState) -> QueryState:
-    """
-    Analytical agent that generates SQL queries from natural language questions
-    and executes them against the database.
-    """
-    # Fetch and save database schema
-    db_schema = await fetch_schema()
-    state['db_schema'] = db_schema
-    
-    query = state.get('query', '')
-    memory_context = state.get('memory_context', {})
-    
-    # Enhance query with conversation context to understand follow-ups
-    enhanced_query = await enhance_query_with_context(query, memory_context)
-    
-    # Build context string for the prompt
-    context_section = ""
-    if memory_context and isinstance(memory_context, dict):
-        context_str = json.dumps(memory_context, indent=2)
-        if context_str and context_str != "{}":
-            context_section = f"""
+"""
 
-CONVERSATION CONTEXT (from previous messages):
-{context_str}
+_TOOL_PROMPT_PREFIX = """Determine which tool to use for the user query below and extract the necessary parameters.
+
+Available tools:
+1. **wikipedia_lookup**: For looking up general information on Wikipedia
+   - Parameter: topic (the topic to look up)
+   - Example: "what is boleto?" -> tool: "wikipedia_lookup", topic: "boleto"
+   
+2. **get_definition**: For defining terms in the context of Brazilian e-commerce
+   - Parameter: term (the term to define)
+   - Example: "what does 'frete' mean?" -> tool: "get_definition", term: "frete"
+
+Set tool to "wikipedia_lookup" or "get_definition" and put its parameter (topic or term) in parameters.
 
-Note: The user question below may be a follow-up to previous queries. Consider the context when generating the SQL query.
 """
-    
-    # Create prompt for Gemini to generate SQL query
-    prompt = f"""Given this PostgreSQL schema: {db_schema}{context_section}
 
-Write a single, valid PostgreSQL query to answer this user question: {enhanced_query}
+_ENHANCE_PROMPT_PREFIX = """You are a query enhancement system for a Brazilian e-commerce database.
+
+Your task is to expand and contextualize the user's current query based on previous conversation history.
 
-IMPORTANT RULES:
+INSTRUCTIONS:
+- If the current query is a follow-up or continuation of a previous query, expand it to include the full context
+- For example, if previous context mentions "products with good reviews" and current query is "bad review", 
+  expand it to "products with bad reviews"
+- If the query is standalone and doesn't reference previous context, return it as-is
+- Preserve the original intent and meaning of the query
+- Make the enhanced query clear and complete for semantic search or SQL generation
+
+Return ONLY the enhanced query string, no explanations, no markdown formatting, no additional text.
+Just return the enhanced query as plain text.
+
+"""
+
+_ANALYTICAL_PROMPT_RULES = """IMPORTANT RULES:
 1. When joining products, also join product_category_translation on product_category_name to get English names.
 2. When calculating price, revenue, or sales, use the price column from order_items table.
 3. For "top N" queries, use ORDER BY with DESC and LIMIT N.
@@ -374,40 +401,434 @@ LIMIT 10;
 
 Return ONLY the SQL string, no explanations, no markdown code blocks."""
 
-    try:
-        # Initialize the Gemini model
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        # Generate response
-        response = model.generate_content(prompt)
+
+class QueryState(TypedDict):
+    query: str
+    intent: str
+    sql_query: Optional[str]
+    results: Optional[List[dict]]
+    visualization_config: Optional[dict]
+    memory_context: dict
+    db_schema: str
+    error: Optional[str]
+    insights: Optional[str]
+
+
+# Intents the router may return; anything else is treated as conversational
+_VALID_INTENTS = frozenset({"analytical", "semantic", "tool", "conversational"})
+
+
+# Response schemas for JSON mode: Gemini returns a bare JSON object of this shape,
+# with no code fences or surrounding prose to strip
+class RouterOutput(TypedDict):
+    intent: str
+    reasoning: str
+
+
+class _VizConfigBase(TypedDict):
+    type: str
+    x_axis: str
+    y_axis: str
+
+
+class VizConfig(_VizConfigBase, total=False):
+    color: str
+
+
+class ToolParameters(TypedDict, total=False):
+    topic: str
+    term: str
+
+
+class ToolRequest(TypedDict):
+    tool: str
+    parameters: ToolParameters
+
+
+# Full product details for semantic search hits. The text is constant (ids are bound
+# as one array parameter), so a single cached plan serves every result count.
+# products.product_id is the primary key, so its columns need not be grouped on.
+_SEMANTIC_SQL = """SELECT 
+    p.product_id,
+    p.product_category_name,
+    p.product_name_lenght,
+    p.product_description_lenght,
+    p.product_photos_qty,
+    p.product_weight_g,
+    p.product_length_cm,
+    p.product_height_cm,
+    p.product_width_cm,
+    t.product_category_name_english, 
+    AVG(r.review_score) as avg_score,
+    COUNT(DISTINCT oi.order_id) as order_count,
+    STRING_AGG(DISTINCT r.review_comment_message, ' | ') FILTER (WHERE r.review_comment_message IS NOT NULL) as reviews
+FROM products p 
+LEFT JOIN product_category_translation t ON p.product_category_name = t.product_category_name 
+LEFT JOIN order_items oi ON p.product_id = oi.product_id 
+LEFT JOIN order_reviews r ON oi.order_id = r.order_id 
+WHERE p.product_id = ANY($1::text[]) 
+GROUP BY p.product_id, t.product_category_name_english"""
+
+
+# Words that make a query lean on earlier turns ("show me those by state", "same for 2017").
+# Beyond the pronouns (it/that/those/these/them) and also/same, follow-up words such as
+# "again", "instead", "more", "previous" are included: a false match only costs the
+# usual enhancement call, while a miss would answer a follow-up without its context
+_REFERENTIAL_RE = re.compile(
+    r"\b(?:it|its|that|those|these|them|they|this|also|same|again|instead|more|other|previous|above)\b",
+    re.IGNORECASE
+)
+# Shortest analytical query treated as self-contained ("top 10 selling products")
+STANDALONE_MIN_WORDS = 4
+
+
+async def enhance_query_with_context(query: str, memory_context: dict) -> str:
+    """
+    Enhance a user query with conversation context to understand follow-up queries.
+    
+    This function uses Gemini to expand and contextualize queries based on previous
+    conversation history. For example, if a user previously asked about "good reviews"
+    and then says "bad review", it will understand this means "products with bad reviews".
+    
+    Args:
+        query: The current user query
+        memory_context: Dictionary containing conversation history from Supermemory
         
-        # Extract text from response
-        sql_query = response.text.strip()
+    Returns:
+        Enhanced query string that includes context from previous conversations
+    """
+    # If no memory context (None or an empty dict), return the original query
+    if not memory_context or not isinstance(memory_context, dict):
+        return query
+    
+    # A complete analytical question with no back-references doesn't need the context
+    if (
+        len(query.split()) >= STANDALONE_MIN_WORDS
+        and _ANALYTICAL_RE.search(query)
+        and not _REFERENTIAL_RE.search(query)
+    ):
+        return query
+    
+    # Compact JSON: indentation only adds prompt tokens
+    context_str = orjson.dumps(memory_context, default=str).decode()
+    
+    # Create prompt for Gemini to enhance the query (static instructions first)
+    prompt = _ENHANCE_PROMPT_PREFIX + f"""CONVERSATION CONTEXT (from previous messages):
+{context_str}
+
+CURRENT USER QUERY:
+"{query}"
+"""
+
+    try:
+        enhanced_query = await llm_text(
+            gemini_model, prompt, ENHANCE_GENERATION_CONFIG, timeout=GEMINI_TIMEOUT
+        )
         
-        # Remove markdown code blocks if present
-        if sql_query.startswith('```sql'):
-            sql_query = sql_query[6:]
-        elif sql_query.startswith('```'):
-            sql_query = sql_query[3:]
-        if sql_query.endswith('```'):
-            sql_query = sql_query[:-3]
-        sql_query = sql_query.strip()
+        # If the enhanced query is empty or just whitespace, return original
+        if not enhanced_query:
+            return query
         
-        # Remove any trailing semicolons and trim
-        sql_query = sql_query.rstrip(';').strip()
+        print(f"Query enhanced: '{query}' -> '{enhanced_query}'")
+        return enhanced_query
         
-        # Log the generated SQL for debugging
-        print(f"Generated SQL query: {sql_query}")
+    except Exception as e:
+        # On any error, return the original query
+        logger.warning("Query enhancement failed: %s", e, exc_info=True)
+        return query
+
+
+# Keyword fast path for the router, each compiled into a single alternation
+_ANALYTICAL_RE = re.compile(
+    r"\b(?:top|highest|lowest|most|least|best|worst|count|sum|average|total|list|show me|"
+    r"number of|how many|which|what are|expensive|cheap(?:er|est)?|sellers by|products by|orders by|"
+    r"revenue|sales)\b",
+    re.IGNORECASE
+)
+# Definitions and translations go to the tool agent even when they contain analytical words
+_TOOL_RE = re.compile(r"\b(?:what is|what does|define|meaning of|translate)\b", re.IGNORECASE)
+
+
+def _fast_classify(query: str) -> Optional[str]:
+    """Return 'analytical' when keywords settle the intent without an LLM call, else None."""
+    if _ANALYTICAL_RE.search(query) and not _TOOL_RE.search(query):
+        return 'analytical'
+    return None
+
+
+async def router_agent(state: QueryState) -> QueryState:
+    """
+    Router agent that classifies user queries into one of four intents:
+    - analytical: queries requiring SQL execution (e.g., "Top 5", "Total sales", "Average score")
+    - semantic: queries requiring RAG retrieval (e.g., "good products", "bad reviews")
+    - tool: queries requiring external API calls (e.g., "what is 'boleto'?", "translate")
+    - conversational: general conversation queries
+    """
+    query = state.get('query', '')
+    memory_context = state.get('memory_context', {})
+    
+    # Fast path: Check for analytical keywords first (before LLM call)
+    # This ensures queries like "Top 5 highest products" are always classified as analytical,
+    # unless it's a tool query (definitions, translations)
+    fast_intent = _fast_classify(query)
+    if fast_intent is not None:
+        print(f"Fast path: Classifying query as {fast_intent} based on keywords: {query}")
+        state['intent'] = fast_intent
+        return state
+    
+    # Check the intent cache before building the prompt; the compact context is all the
+    # router sees, so it is also the cache key
+    context_digest = _compact_context(memory_context)
+    cache_key = make_key(normalize_query(query), context_digest)
+    cached_intent = intent_cache.get(cache_key)
+    if cached_intent is not None:
+        print(f"Intent cache hit: {cached_intent} for query: {query}")
+        state['intent'] = cached_intent
+        return state
+    
+    # Speculatively warm the schema cache while Gemini classifies the query;
+    # analytical_agent's fetch_schema() then hits the cache or joins the in-flight load
+    prefetch_task = asyncio.create_task(_prefetch_schema())
+    _background_tasks.add(prefetch_task)
+    prefetch_task.add_done_callback(_background_tasks.discard)
+    
+    # Create detailed prompt for intent classification
+    prompt = _ROUTER_PROMPT_PREFIX + f"""CONVERSATION CONTEXT:
+{context_digest}
+
+USER QUERY:
+"{query}"
+"""
+
+    # Start classification right away; the semantic cache lookup runs alongside it
+    llm_task = asyncio.create_task(llm_json(
+        gemini_model, prompt, RouterOutput,
+        timeout=GEMINI_TIMEOUT, max_output_tokens=JSON_MAX_OUTPUT_TOKENS
+    ))
+    
+    # Semantic tier: near-duplicate queries reuse a stored intent. Only used without
+    # conversation context, since follow-ups can change the intent of identical text.
+    # The embedding races the classification; if Gemini answers first the lookup is
+    # skipped, so the router stays bounded by GEMINI_TIMEOUT
+    embed_task = None
+    if not memory_context:
+        embed_task = asyncio.create_task(embed_query(query))
+        _background_tasks.add(embed_task)
+        embed_task.add_done_callback(_background_tasks.discard)
+        await asyncio.wait({llm_task, embed_task}, return_when=asyncio.FIRST_COMPLETED)
+        if embed_task.done():
+            try:
+                cached_intent = semantic_intent_cache.get(embed_task.result())
+                if cached_intent is not None:
+                    llm_task.cancel()
+                    print(f"Semantic intent cache hit: {cached_intent} for query: {query}")
+                    state['intent'] = cached_intent
+                    intent_cache.set(cache_key, cached_intent)
+                    return state
+            except Exception as e:
+                logger.warning("Semantic intent cache lookup failed: %s", e)
+    
+    # Await the classification started above (None if it failed or timed out)
+    parsed_response = await llm_task
+    if parsed_response is None:
+        if embed_task is not None:
+            _store_embedding_later(embed_task, semantic_intent_cache, None)
+        # The fast path already ruled out clean keyword matches; what is left with
+        # analytical keywords also had a tool phrase, and analytical is the safer guess
+        state['intent'] = 'analytical' if _ANALYTICAL_RE.search(query) else 'conversational'
+        print(f"Router failed; falling back to {state['intent']} for query: {query}")
+        return state
+    
+    # Normalise the reply ("Analytical " -> "analytical"); anything still unknown is
+    # answered with the failure fallback and never cached, so one bad reply isn't
+    # served to every matching query for the cache TTL
+    intent = str(parsed_response.get('intent') or '').strip().lower()
+    if intent not in _VALID_INTENTS:
+        if embed_task is not None:
+            _store_embedding_later(embed_task, semantic_intent_cache, None)
+        state['intent'] = 'analytical' if _ANALYTICAL_RE.search(query) else 'conversational'
+        logger.warning("Router returned unknown intent %r; falling back to %s", intent, state['intent'])
+        return state
+    
+    # Debug: Print parsed intent
+    print(f"Router agent classified intent: {intent} for query: {query}")
+    
+    # Update state with the classified intent
+    state['intent'] = intent
+    intent_cache.set(cache_key, intent)
+    # Tool requests depend on the exact term asked about; keep them out of the fuzzy tier
+    if embed_task is not None:
+        _store_embedding_later(embed_task, semantic_intent_cache, intent if intent != 'tool' else None)
+    
+    return state
+
+
+def _store_embedding_later(embed_task: asyncio.Task, cache: SemanticCache, value: Any) -> None:
+    """
+    Store value in a semantic cache under the query's embedding once embed_task
+    finishes, which may be after the agent has returned. None stores nothing.
+    """
+    def store(task: asyncio.Task) -> None:
+        # Also marks a failed embedding's exception as retrieved
+        if task.cancelled() or task.exception() is not None:
+            return
+        if value is not None:
+            cache.set(task.result(), value)
+    
+    embed_task.add_done_callback(store)
+
+
+# Offline batch classification: queries per Gemini call, and the bound on each call
+ROUTER_BATCH_SIZE = 50
+ROUTER_BATCH_TIMEOUT = 60.0
+
+
+class RouterBatchOutput(TypedDict):
+    intents: List[str]
+
+
+async def classify_queries(queries: List[str]) -> List[str]:
+    """
+    Classify many standalone queries at once, for offline use such as evaluation runs,
+    replaying logged traffic, or warming the intent cache at startup (ROUTER_WARMUP_FILE
+    in main.py); the request path keeps using router_agent. Results fill intent_cache.
+    
+    Keyword fast-path and intent-cache hits are resolved locally; the remaining
+    queries are classified ROUTER_BATCH_SIZE at a time with one Gemini call per
+    batch, and the batches are issued concurrently.
+    
+    Args:
+        queries: The user queries to classify (no conversation context)
+    
+    Returns:
+        One intent per query, in the same order
+    """
+    no_context = _compact_context({})
+    intents: List[Optional[str]] = [None] * len(queries)
+    pending = []
+    for i, query in enumerate(queries):
+        intents[i] = _fast_classify(query) or intent_cache.get(make_key(normalize_query(query), no_context))
+        if intents[i] is None:
+            pending.append(i)
+    
+    async def classify_batch(indices: List[int]):
+        numbered = "\n".join(f'{n}. "{queries[i]}"' for n, i in enumerate(indices, 1))
+        prompt = _ROUTER_PROMPT_PREFIX + f"""BATCH MODE: Classify each of the following {len(indices)} queries
+independently (there is no conversation context) and give exactly one intent per query,
+in the same order.
+
+USER QUERIES:
+{numbered}
+"""
+        parsed = await llm_json(
+            gemini_model, prompt, RouterBatchOutput,
+            timeout=ROUTER_BATCH_TIMEOUT, max_output_tokens=ROUTER_BATCH_MAX_OUTPUT_TOKENS
+        )
+        batch_intents = (parsed or {}).get('intents') or []
+        for n, i in enumerate(indices):
+            intent = batch_intents[n] if n < len(batch_intents) else None
+            if intent in _VALID_INTENTS:
+                intents[i] = intent
+                intent_cache.set(make_key(normalize_query(queries[i]), no_context), intent)
+            else:
+                intents[i] = 'conversational'
+    
+    await asyncio.gather(*(
+        classify_batch(pending[start:start + ROUTER_BATCH_SIZE])
+        for start in range(0, len(pending), ROUTER_BATCH_SIZE)
+    ))
+    return intents
+
+
+_ANALYTICAL_QUESTION_PREFIX = "\nWrite a single, valid PostgreSQL query to answer this user question: "
+
+
+@functools.lru_cache(maxsize=4)
+def _analytical_sql_context(db_schema: str) -> str:
+    """Static part of the SQL prompt (schema + rules), built once per schema text."""
+    return f"Given this PostgreSQL schema: {db_schema}\n\n{_ANALYTICAL_PROMPT_RULES}"
+
+
+async def analytical_agent(state: QueryState) -> QueryState:
+    """
+    Analytical agent that generates SQL queries from natural language questions
+    and executes them against the database.
+    """
+    query = state.get('query', '')
+    memory_context = state.get('memory_context', {})
+    
+    # Build context string for the prompt
+    context_section = ""
+    context_str = ""
+    if memory_context and isinstance(memory_context, dict):
+        # Compact JSON: indentation only adds prompt tokens
+        context_str = orjson.dumps(memory_context, default=str).decode()
+        context_section = f"""
+
+CONVERSATION CONTEXT (from previous messages):
+{context_str}
+
+Note: The user question below may be a follow-up to previous queries. Consider the context when generating the SQL query.
+"""
+    
+    # Exact repeats (same question, context and schema) reuse the generated SQL and skip
+    # both the enhancement and SQL-generation calls. The raw question is the key: the
+    # enhanced query is derived from it and the context, which are both part of the key.
+    schema_fingerprint = get_schema_fingerprint()
+    sql_cache_key = make_key(normalize_query(query), schema_fingerprint, context_str)
+    sql_query = sql_cache.get(sql_cache_key) if schema_fingerprint else None
+    if sql_query is not None:
+        db_schema = await fetch_schema()
+        enhanced_query = query
+    else:
+        # Fetch the database schema and enhance the query with conversation context
+        # concurrently; neither depends on the other
+        db_schema, enhanced_query = await asyncio.gather(
+            fetch_schema(),
+            enhance_query_with_context(query, memory_context)
+        )
+        # The schema may have just been loaded, so key on its current fingerprint
+        sql_cache_key = make_key(normalize_query(query), get_schema_fingerprint(), context_str)
+    state['db_schema'] = db_schema
+    
+    try:
+        if sql_query is not None:
+            print(f"SQL cache hit: {sql_query}")
+        else:
+            # Static part (schema + rules) first, then the per-request context and question;
+            # the static part is served from a Gemini context cache when one is available
+            sql_context = _analytical_sql_context(db_schema)
+            question = "".join((context_section, _ANALYTICAL_QUESTION_PREFIX, enhanced_query))
+            sql_model = await _get_sql_model(sql_context)
+            prompt = question if sql_model is not None else "".join((sql_context, "\n\n", question))
+            
+            # Stream the response so chunks are consumed as Gemini decodes them
+            sql_query = await llm_text(
+                sql_model or gemini_model, prompt, SQL_GENERATION_CONFIG,
+                timeout=GEMINI_SQL_TIMEOUT, stream=True
+            )
+            
+            # Keep a single read-only statement with a bounded row count
+            sql_query = _safeguard_sql(sql_query)
+            
+            # Log the generated SQL for debugging
+            print(f"Generated SQL query: {sql_query}")
         
         # Save SQL query to state
         state['sql_query'] = sql_query
         
-        # Execute the query
-        results = await execute_query(sql_query)
-        
-        # Ensure results is always a list (never None)
+        # Execute the query (short-lived results cache for exact repeats)
+        results = results_cache.get(sql_query)
         if results is None:
-            results = []
+            results = await execute_query(sql_query)
+            
+            # Ensure results is always a list (never None)
+            if results is None:
+                results = []
+            
+            # Only cache SQL that executed successfully
+            sql_cache.set(sql_cache_key, sql_query)
+            results_cache.set(sql_query, results)
         
         # Log results count for debugging
         print(f"Query returned {len(results)} results")
@@ -421,10 +842,7 @@ Return ONLY the SQL string, no explanations, no markdown code blocks."""
         
     except Exception as e:
         # Handle errors gracefully
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Error in analytical_agent: {error_trace}")
-        print(f"SQL query that failed: {state.get('sql_query', 'N/A')}")
+        logger.warning("analytical_agent failed: %s; SQL query: %s", e, state.get('sql_query', 'N/A'), exc_info=True)
         
         # Set results to empty array instead of None
         state['results'] = []
@@ -432,7 +850,9 @@ Return ONLY the SQL string, no explanations, no markdown code blocks."""
         
         # Store error message in a separate field for frontend
         error_message = f"Error executing query: {str(e)}"
-        if "syntax error" in str(e).lower() or "invalid" in str(e).lower():
+        if isinstance(e, asyncio.TimeoutError):
+            error_message = f"SQL generation timed out after {GEMINI_SQL_TIMEOUT:g}s"
+        elif "syntax error" in str(e).lower() or "invalid" in str(e).lower():
             error_message = f"SQL syntax error: {str(e)}"
         elif "does not exist" in str(e).lower() or "relation" in str(e).lower():
             error_message = f"Database error - table or column not found: {str(e)}"
@@ -454,49 +874,21 @@ async def semantic_agent(state: QueryState) -> QueryState:
         # Enhance query with conversation context to understand follow-ups
         enhanced_query = await enhance_query_with_context(query, memory_context)
         
-        # Call semantic_search with the enhanced query
-        product_ids = await semantic_search(enhanced_query)
+        # Call semantic_search with the enhanced query; make sure the DB pool is ready
+        # (created and connected on first use) while the vector lookup is in flight
+        product_ids, _ = await asyncio.gather(
+            semantic_search(enhanced_query),
+            get_pool()
+        )
         
         # If no product_ids are found, return an empty state
         if not product_ids:
             state['results'] = []
             return state
         
-        # Construct SQL query to get the full details for these products
-        product_ids_str = ', '.join(f"'{pid}'" for pid in product_ids)
-        sql_query = f"""SELECT 
-    p.product_id,
-    p.product_category_name,
-    p.product_name_lenght,
-    p.product_description_lenght,
-    p.product_photos_qty,
-    p.product_weight_g,
-    p.product_length_cm,
-    p.product_height_cm,
-    p.product_width_cm,
-    t.product_category_name_english, 
-    AVG(r.review_score) as avg_score,
-    COUNT(DISTINCT oi.order_id) as order_count,
-    STRING_AGG(DISTINCT r.review_comment_message, ' | ') FILTER (WHERE r.review_comment_message IS NOT NULL) as reviews
-FROM products p 
-LEFT JOIN product_category_translation t ON p.product_category_name = t.product_category_name 
-LEFT JOIN order_items oi ON p.product_id = oi.product_id 
-LEFT JOIN order_reviews r ON oi.order_id = r.order_id 
-WHERE p.product_id IN ({product_ids_str}) 
-GROUP BY 
-    p.product_id,
-    p.product_category_name,
-    p.product_name_lenght,
-    p.product_description_lenght,
-    p.product_photos_qty,
-    p.product_weight_g,
-    p.product_length_cm,
-    p.product_height_cm,
-    p.product_width_cm,
-    t.product_category_name_english"""
         
-        # Execute the SQL query
-        results = await execute_query(sql_query)
+        # Execute the constant SQL with the product ids bound as a single array parameter
+        results = await execute_query(_SEMANTIC_SQL, product_ids)
         
         # Ensure results is always a list (never None)
         if results is None:
@@ -511,9 +903,7 @@ GROUP BY
         
     except Exception as e:
         # Handle errors gracefully
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Error in semantic_agent: {error_trace}")
+        logger.warning("semantic_agent failed: %s", e, exc_info=True)
         state['results'] = []
         state['error'] = f"Error performing semantic search: {str(e)}"
     
@@ -528,52 +918,27 @@ async def tool_agent(state: QueryState) -> QueryState:
     """
     query = state.get('query', '')
     
-    # Create prompt for Gemini to parse the query and extract tool name and parameters
-    prompt = f"""Given this user query: "{query}"
-
-Determine which tool to use and extract the necessary parameters.
-
-Available tools:
-1. **wikipedia_lookup**: For looking up general information on Wikipedia
-   - Parameter: topic (the topic to look up)
-   - Example: "what is boleto?" -> tool: "wikipedia_lookup", topic: "boleto"
-   
-2. **get_definition**: For defining terms in the context of Brazilian e-commerce
-   - Parameter: term (the term to define)
-   - Example: "what does 'frete' mean?" -> tool: "get_definition", term: "frete"
-
-Return ONLY a valid JSON object with this exact structure:
-{{
-  "tool": "wikipedia_lookup" | "get_definition",
-  "parameters": {{
-    "topic": "string" (for wikipedia_lookup) OR
-    "term": "string" (for get_definition)
-  }}
-}}
-
-Return only the JSON object, no additional text or markdown formatting."""
-
+    # Repeated questions reuse the parsed tool request instead of asking Gemini again
+    tool_cache_key = make_key(normalize_query(query))
+    
     try:
-        # Initialize the Gemini model
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        # Generate response
-        response = model.generate_content(prompt)
-        
-        # Extract text from response
-        response_text = response.text.strip()
-        
-        # Remove markdown code blocks if present
-        if response_text.startswith('```json'):
-            response_text = response_text[7:]
-        if response_text.startswith('```'):
-            response_text = response_text[3:]
-        if response_text.endswith('```'):
-            response_text = response_text[:-3]
-        response_text = response_text.strip()
-        
-        # Parse JSON response
-        parsed_response = json.loads(response_text)
+        parsed_response = tool_cache.get(tool_cache_key)
+        if parsed_response is None:
+            # Create prompt for Gemini to parse the query and extract tool name and parameters
+            prompt = _TOOL_PROMPT_PREFIX + f"""USER QUERY:
+"{query}"
+"""
+            
+            # JSON mode returns a bare object; None means the call failed or timed out
+            parsed_response = await llm_json(
+                gemini_model, prompt, ToolRequest,
+                timeout=GEMINI_TIMEOUT, max_output_tokens=JSON_MAX_OUTPUT_TOKENS
+            )
+            if parsed_response is None:
+                state['results'] = [{'text': 'Error: Could not parse tool request'}]
+                state['visualization_config'] = {'type': 'text'}
+                return state
+            tool_cache.set(tool_cache_key, parsed_response)
         
         tool_name = parsed_response.get('tool', '')
         parameters = parsed_response.get('parameters', {})
@@ -593,20 +958,89 @@ Return only the JSON object, no additional text or markdown formatting."""
         state['results'] = [{'text': result_text}]
         state['visualization_config'] = {'type': 'text'}
         
-    except json.JSONDecodeError as e:
-        # Fallback error handling
-        print(f"Error parsing JSON response in tool_agent: {e}")
-        state['results'] = [{'text': 'Error: Could not parse tool request'}]
-        state['visualization_config'] = {'type': 'text'}
     except Exception as e:
         # Handle errors gracefully
-        print(f"Error in tool_agent: {e}")
+        logger.warning("tool_agent failed: %s", e, exc_info=True)
         state['results'] = [{'text': f'Error: {str(e)}'}]
         state['visualization_config'] = {'type': 'text'}
     
     return state
 
 
+# Category counts for which a single-measure result is drawn as a bar chart outright
+VIZ_BAR_MIN_ROWS = 2
+VIZ_BAR_MAX_ROWS = 30
+
+
+def _heuristic_viz_config(results: List[dict], numeric_columns: List[str], temporal_columns: List[str]) -> Optional[dict]:
+    """
+    Pick a visualization for result shapes that don't need the LLM.
+    
+    Args:
+        results: The query results (non-empty)
+        numeric_columns: Columns holding numbers in the first row
+        temporal_columns: Columns holding dates/timestamps in the first row
+    
+    Returns:
+        A visualization config, or None if the shape is ambiguous
+    """
+    # Single rows and results with nothing to plot are shown as a table
+    if len(results) <= 1 or not numeric_columns:
+        return {"type": "table", "x_axis": None, "y_axis": None}
+    
+    # A measure over an ordered date column is a time series
+    if temporal_columns:
+        x_values = [row.get(temporal_columns[0]) for row in results]
+        if None not in x_values:
+            pairs = list(zip(x_values, x_values[1:]))
+            if all(a <= b for a, b in pairs) or all(a >= b for a, b in pairs):
+                return {"type": "line", "x_axis": temporal_columns[0], "y_axis": numeric_columns[0]}
+    
+    # One category column and one measure with a modest number of rows is a bar chart
+    category_columns = [key for key in results[0] if key not in numeric_columns and key not in temporal_columns]
+    if (
+        len(numeric_columns) == 1
+        and len(category_columns) == 1
+        and VIZ_BAR_MIN_ROWS <= len(results) <= VIZ_BAR_MAX_ROWS
+    ):
+        return {"type": "bar", "x_axis": category_columns[0], "y_axis": numeric_columns[0]}
+    
+    return None
+
+
+def _column_kind(key: str, value) -> Optional[str]:
+    """Classify a result column from its first-row value: numeric, temporal, text (long strings), id, or None."""
+    if isinstance(value, (int, float)):
+        return 'numeric'
+    if isinstance(value, datetime.date):
+        return 'temporal'
+    if isinstance(value, str) and len(value) > 50:
+        return 'text'
+    if key.endswith('_id'):
+        return 'id'
+    return None
+
+
+# Rows scanned for a non-NULL sample of each column when typing result columns
+VIZ_TYPING_ROWS = 50
+
+
+def _first_values(results: List[dict]) -> dict:
+    """
+    Return each column's first non-NULL value within the first VIZ_TYPING_ROWS rows
+    (None if it has none), so a NULL in row one doesn't hide a numeric column.
+    """
+    values = dict.fromkeys(results[0])
+    missing = set(values)
+    for row in results[:VIZ_TYPING_ROWS]:
+        if not missing:
+            break
+        for key in [key for key in missing if row.get(key) is not None]:
+            values[key] = row[key]
+            missing.discard(key)
+    return values
+
+
 async def viz_generator(state: QueryState) -> QueryState:
     """
     Visualization generator that recommends the best visualization type
@@ -630,20 +1064,12 @@ async def viz_generator(state: QueryState) -> QueryState:
     # Get a sample of the results (first 5 rows) for the prompt
     sample_results = results[:5] if len(results) > 5 else results
     
-    # Detect numeric columns that could be good for visualization
-    numeric_columns = []
-    text_columns = []
-    id_columns = []
-    
-    if len(results) > 0:
-        first_row = results[0]
-        for key, value in first_row.items():
-            if isinstance(value, (int, float)) and value is not None:
-                numeric_columns.append(key)
-            elif isinstance(value, str) and len(str(value)) > 50:
-                text_columns.append(key)
-            elif key.endswith('_id') or key == 'product_id':
-                id_columns.append(key)
+    # Classify every column once, from its first non-NULL value, then split by kind
+    column_kinds = {key: _column_kind(key, value) for key, value in _first_values(results).items()}
+    numeric_columns = [key for key, kind in column_kinds.items() if kind == 'numeric']
+    temporal_columns = [key for key, kind in column_kinds.items() if kind == 'temporal']
+    text_columns = [key for key, kind in column_kinds.items() if kind == 'text']
+    id_columns = [key for key, kind in column_kinds.items() if kind == 'id']
     
     # Check if query mentions ratings, scores, or comparisons
     query_lower = query.lower()
@@ -657,100 +1083,85 @@ async def viz_generator(state: QueryState) -> QueryState:
     elif mentions_comparison and len(numeric_columns) > 0:
         preferred_chart = "bar"
     
-    # Create prompt for Gemini with enhanced guidance
-    prompt = f"""Based on this data: {json.dumps(sample_results, indent=2)}
-
-And the user's query: "{query}"
-
-IMPORTANT GUIDELINES:
-- If the query mentions "ratings", "scores", "bad ratings", "good ratings", or similar, and the data has an "avg_score" or similar numeric column, use a BAR CHART to visualize products by their scores.
-- If the query asks for comparisons, rankings, or "top/best/worst", prefer BAR or LINE charts over tables.
-- Use BAR charts when comparing numeric values across categories (e.g., products by score, products by order count).
-- Use LINE charts only for time-series data or sequential trends.
-- Use TABLE only when the data is primarily text-based (like reviews, descriptions) or when there are too many columns to visualize effectively.
-- For queries about "bad ratings" or "low scores", create a bar chart with product_id or product_category_name_english on x-axis and avg_score on y-axis.
-
-Available numeric columns: {numeric_columns}
+    # Obvious result shapes are decided without an LLM call
+    heuristic_config = _heuristic_viz_config(results, numeric_columns, temporal_columns)
+    if heuristic_config is not None:
+        state['visualization_config'] = heuristic_config
+        return state
+    
+    # Ratings and comparison queries get a bar chart without an LLM call either
+    if preferred_chart == "bar":
+        first_row_keys = list(results[0].keys())
+        label_columns = [key for key in first_row_keys if key not in numeric_columns]
+        x_axis_col = "product_id" if "product_id" in first_row_keys else (id_columns[0] if id_columns else (label_columns[0] if label_columns else first_row_keys[0]))
+        y_axis_col = "avg_score" if mentions_ratings and 'avg_score' in numeric_columns else numeric_columns[0]
+        state['visualization_config'] = {"type": "bar", "x_axis": x_axis_col, "y_axis": y_axis_col}
+        return state
+    
+    # Same question over the same column shape: reuse the earlier recommendation
+    column_shape = ",".join(f"{key}:{type(value).__name__}" for key, value in results[0].items())
+    viz_cache_key = make_key(normalize_query(query), column_shape)
+    cached_config = viz_cache.get(viz_cache_key)
+    if cached_config is not None:
+        state['visualization_config'] = cached_config
+        return state
+    
+    # Create prompt for Gemini with enhanced guidance (static guidelines first, data last)
+    prompt = _VIZ_PROMPT_PREFIX + f"""Available numeric columns: {numeric_columns}
 Available text columns: {text_columns}
 Available ID columns: {id_columns}
 
-What is the best visualization? Recommend type: 'bar', 'line', 'table', or 'map' and the columns for x_axis, y_axis, and color.
+The user's query: "{query}"
 
-Return pure JSON with this structure:
-{{
-  "type": "bar" | "line" | "table" | "map",
-  "x_axis": "column_name",
-  "y_axis": "column_name",
-  "color": "column_name" (optional)
-}}
+The data: {orjson.dumps(sample_results, option=orjson.OPT_INDENT_2, default=str).decode()}"""
 
-Return only the JSON object, no additional text or markdown formatting."""
-
-    try:
-        # Initialize the Gemini model
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        # Generate response
-        response = model.generate_content(prompt)
-        
-        # Extract text from response
-        response_text = response.text.strip()
-        
-        # Remove markdown code blocks if present
-        if response_text.startswith('```json'):
-            response_text = response_text[7:]
-        if response_text.startswith('```'):
-            response_text = response_text[3:]
-        if response_text.endswith('```'):
-            response_text = response_text[:-3]
-        response_text = response_text.strip()
-        
-        # Parse JSON response
-        visualization_config = json.loads(response_text)
-        
-        # Override with bar chart if query mentions ratings/scores and we have avg_score
-        # but Gemini chose table instead
-        if mentions_ratings and 'avg_score' in numeric_columns:
-            if visualization_config.get('type') == 'table':
-                # Force bar chart for rating queries
-                first_row_keys = list(results[0].keys())
-                x_axis_col = "product_id" if "product_id" in first_row_keys else (id_columns[0] if id_columns else first_row_keys[0])
-                visualization_config = {
-                    "type": "bar",
-                    "x_axis": x_axis_col,
-                    "y_axis": "avg_score"
-                }
-                print(f"Overriding visualization to bar chart for ratings query")
-        
-        # Save to state
-        state['visualization_config'] = visualization_config
-        
-    except json.JSONDecodeError as e:
-        # Fallback logic: if query mentions ratings and we have avg_score, use bar chart
-        print(f"Error parsing JSON response: {e}")
-        if mentions_ratings and 'avg_score' in numeric_columns and len(results) > 0:
-            state['visualization_config'] = {
-                "type": "bar",
-                "x_axis": "product_id" if "product_id" in results[0] else (id_columns[0] if id_columns else list(results[0].keys())[0]),
-                "y_axis": "avg_score"
-            }
-        else:
-            state['visualization_config'] = {"type": "table"}
-    except Exception as e:
-        # Fallback logic: if query mentions ratings and we have avg_score, use bar chart
-        print(f"Error in viz_generator: {e}")
-        if mentions_ratings and 'avg_score' in numeric_columns and len(results) > 0:
-            state['visualization_config'] = {
-                "type": "bar",
-                "x_axis": "product_id" if "product_id" in results[0] else (id_columns[0] if id_columns else list(results[0].keys())[0]),
-                "y_axis": "avg_score"
-            }
-        else:
-            state['visualization_config'] = {"type": "table"}
+    visualization_config = await llm_json(
+        gemini_model, prompt, VizConfig,
+        timeout=GEMINI_TIMEOUT, max_output_tokens=JSON_MAX_OUTPUT_TOKENS
+    )
+    if visualization_config is None:
+        state['visualization_config'] = {"type": "table"}
+        return state
     
+    # Save to state
+    state['visualization_config'] = visualization_config
+    viz_cache.set(viz_cache_key, visualization_config)
     return state
 
 
+# Longest string value sent to the model per cell (e.g. review text)
+PROMPT_CELL_MAX_CHARS = 200
+
+
+def _compact_rows(rows: List[dict]) -> str:
+    """Serialize result rows as compact JSON for a prompt, truncating long string values."""
+    return orjson.dumps(
+        [
+            {key: value[:PROMPT_CELL_MAX_CHARS] if isinstance(value, str) else value for key, value in row.items()}
+            for row in rows
+        ],
+        default=str
+    ).decode()
+
+
+# Insights cleanup patterns. The emoji class covers the individual symbols the model
+# tends to use (📈, 🚀, ✨, ⭐, ...) as well as the emoji blocks.
+_EMOJI_RE = re.compile(
+    "["
+    "\U0001F600-\U0001F64F"  # emoticons
+    "\U0001F300-\U0001F5FF"  # symbols & pictographs
+    "\U0001F680-\U0001F6FF"  # transport & map symbols
+    "\U0001F1E0-\U0001F1FF"  # flags (iOS)
+    "\U00002702-\U000027B0"
+    "\U000024C2-\U0001F251"
+    "]+"
+)
+_BLANK_LINES_RE = re.compile(r'\n\s*\n\s*\n')
+_LEADING_WS_RE = re.compile(r'^\s+', re.MULTILINE)
+# Line already starts with a bullet or a numbered-list marker
+_BULLET_RE = re.compile(r'•|-|\*|[1-5]\.')
+
+
 async def insights_agent(state: QueryState) -> QueryState:
     """
     Insights agent that generates AI-powered insights from query results.
@@ -758,7 +1169,6 @@ async def insights_agent(state: QueryState) -> QueryState:
     """
     results = state.get('results', [])
     query = state.get('query', '')
-    visualization_config = state.get('visualization_config', {})
     
     # Skip insights generation if there's an error or no results
     if state.get('error') or not results or len(results) == 0:
@@ -770,19 +1180,30 @@ async def insights_agent(state: QueryState) -> QueryState:
         state['insights'] = None
         return state
     
+    embed_task = None
     try:
         # Get a sample of results (first 20 rows) for analysis
         sample_results = results[:20] if len(results) > 20 else results
         
+        # The same data asked about the same way gets the same insights: exact query
+        # first, then near-duplicate phrasings that produced identical results
+        results_digest = make_key(
+            str(len(results)),
+            orjson.dumps(sample_results, option=orjson.OPT_SORT_KEYS, default=str).decode()
+        )
+        insights_cache_key = make_key(normalize_query(query), results_digest)
+        cached_insights = insights_cache.get(insights_cache_key)
+        if cached_insights is not None:
+            state['insights'] = cached_insights
+            return state
+        
         # Create prompt for Gemini to generate insights
         prompt = f"""You are an expert data analyst for a Brazilian e-commerce platform. Analyze the following query results and generate professional, business-focused insights.
 
 USER QUERY: "{query}"
 
-VISUALIZATION TYPE: {visualization_config.get('type', 'unknown')}
-
 DATA SAMPLE (first {len(sample_results)} of {len(results)} results):
-{json.dumps(sample_results, indent=2)}
+{_compact_rows(sample_results)}
 
 TOTAL RESULTS: {len(results)}
 
@@ -809,87 +1230,90 @@ CRITICAL FORMATTING REQUIREMENTS:
 
 Return ONLY the insights in the exact format specified above. No additional text or explanations."""
 
-        # Initialize the Gemini model
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        # Generate response
-        response = model.generate_content(prompt)
-        
-        # Extract text from response
-        insights_text = response.text.strip()
-        
-        # Remove markdown code blocks if present
-        if insights_text.startswith('```'):
-            lines = insights_text.split('\n')
-            if lines[0].startswith('```'):
-                lines = lines[1:]
-            if lines and lines[-1].strip() == '```':
-                lines = lines[:-1]
-            insights_text = '\n'.join(lines).strip()
-        
-        # Clean up the insights: remove emojis and improve formatting
-        import re
-        # Remove common emojis (basic emoji pattern)
-        insights_text = re.sub(r'[📈🚀💡🏆📊✨🎯💼🔍⭐🌟]', '', insights_text)
-        # Remove emoji patterns more comprehensively
-        emoji_pattern = re.compile("["
-            u"\U0001F600-\U0001F64F"  # emoticons
-            u"\U0001F300-\U0001F5FF"  # symbols & pictographs
-            u"\U0001F680-\U0001F6FF"  # transport & map symbols
-            u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
-            u"\U00002702-\U000027B0"
-            u"\U000024C2-\U0001F251"
-            "]+", flags=re.UNICODE)
-        insights_text = emoji_pattern.sub('', insights_text)
-        
-        # Clean up extra whitespace
-        insights_text = re.sub(r'\n\s*\n\s*\n', '\n\n', insights_text)  # Multiple newlines to double
-        insights_text = re.sub(r'^\s+', '', insights_text, flags=re.MULTILINE)  # Leading whitespace
+        # Generate with the shared model (code fences are stripped in one regex pass).
+        # Started first so the semantic lookup below never delays it
+        insights_task = asyncio.create_task(
+            llm_text(gemini_model, prompt, timeout=GEMINI_INSIGHTS_TIMEOUT)
+        )
+        
+        # Near-duplicate phrasings that produced identical results reuse their insights.
+        # The embedding only gets INSIGHTS_EMBEDDING_TIMEOUT; if it's slower, the
+        # lookup is skipped and it finishes in the background to store this answer
+        embed_task = asyncio.create_task(embed_query(query))
+        _background_tasks.add(embed_task)
+        embed_task.add_done_callback(_background_tasks.discard)
+        try:
+            embedding = await asyncio.wait_for(asyncio.shield(embed_task), INSIGHTS_EMBEDDING_TIMEOUT)
+            cached = semantic_insights_cache.get(embedding)
+            if cached is not None and cached[0] == results_digest:
+                insights_task.cancel()
+                print(f"Semantic insights cache hit for query: {query}")
+                state['insights'] = cached[1]
+                insights_cache.set(insights_cache_key, cached[1])
+                return state
+        except asyncio.TimeoutError:
+            # Expected when the embedding is slow: skip the lookup, Gemini is already running
+            logger.debug("Query embedding not ready for the semantic insights lookup")
+        except Exception as e:
+            logger.warning("Semantic insights cache lookup failed: %s", e)
+        
+        insights_text = await insights_task
+        
+        # Clean up the insights: remove emojis and extra whitespace
+        insights_text = _EMOJI_RE.sub('', insights_text)
+        insights_text = _BLANK_LINES_RE.sub('\n\n', insights_text)  # Multiple newlines to double
+        insights_text = _LEADING_WS_RE.sub('', insights_text)  # Leading whitespace
         insights_text = insights_text.strip()
         
-        # Ensure proper bullet point formatting
-        lines = insights_text.split('\n')
-        cleaned_lines = []
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            # If line doesn't start with bullet, add one if it looks like a new insight
-            if not line.startswith(('•', '-', '*', '1.', '2.', '3.', '4.', '5.')):
-                # Check if it's a new paragraph/insight (starts with capital or number)
-                if line and (line[0].isupper() or line[0].isdigit()):
-                    # Check if previous line was also an insight (not empty)
-                    if cleaned_lines and cleaned_lines[-1].strip():
-                        line = '• ' + line
-            cleaned_lines.append(line)
-        
-        insights_text = '\n'.join(cleaned_lines)
+        # Ensure proper bullet point formatting: after the first line, a non-empty line
+        # that starts a new insight (capital or digit) without a bullet gets one
+        lines = [line for line in map(str.strip, insights_text.split('\n')) if line]
+        insights_text = '\n'.join(
+            '• ' + line
+            if i and not _BULLET_RE.match(line) and (line[0].isupper() or line[0].isdigit())
+            else line
+            for i, line in enumerate(lines)
+        )
         
         # Save insights to state
         state['insights'] = insights_text
+        insights_cache.set(insights_cache_key, insights_text)
+        _store_embedding_later(embed_task, semantic_insights_cache, (results_digest, insights_text))
         
         print(f"Generated insights for query: {query}")
         
     except Exception as e:
         # On error, set insights to None (don't fail the whole workflow)
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Error generating insights: {error_trace}")
+        logger.warning("insights_agent failed: %s", e, exc_info=True)
         state['insights'] = None
+        if embed_task is not None:
+            _store_embedding_later(embed_task, semantic_insights_cache, None)
     
     return state
 
 
+async def present_results(state: QueryState) -> QueryState:
+    """
+    Produce the visualization config and the insights for a result set concurrently.
+    Both only read the query and results, so each runs on its own copy of the state
+    and just its output key is merged back.
+    """
+    viz_state, insights_state = await asyncio.gather(
+        viz_generator(dict(state)),
+        insights_agent(dict(state))
+    )
+    state['visualization_config'] = viz_state.get('visualization_config')
+    state['insights'] = insights_state.get('insights')
+    return state
+
+
 def route_after_router(state: QueryState) -> Literal["analytical", "semantic", "tool", "conversational"]:
     """
     Conditional routing function that routes based on intent.
     """
     intent = state.get('intent', 'conversational')
     # Ensure intent is one of the valid values
-    valid_intents = ["analytical", "semantic", "tool", "conversational"]
-    if intent not in valid_intents:
-        intent = "conversational"
-    return intent  # type: ignore
+    return intent if intent in _VALID_INTENTS else "conversational"  # type: ignore
 
 
 # Initialize workflow
@@ -900,8 +1324,7 @@ workflow.add_node("router", router_agent)
 workflow.add_node("analytical", analytical_agent)
 workflow.add_node("semantic", semantic_agent)
 workflow.add_node("tool", tool_agent)
-workflow.add_node("visualizer", viz_generator)
-workflow.add_node("insights_generator", insights_agent)
+workflow.add_node("presenter", present_results)
 
 # Set the router as the entry point
 workflow.set_entry_point("router")
@@ -918,17 +1341,18 @@ workflow.add_conditional_edges(
     }
 )
 
-# Add normal edges from analytical to visualizer and semantic to visualizer
-workflow.add_edge("analytical", "visualizer")
-workflow.add_edge("semantic", "visualizer")
+# Add normal edges from analytical and semantic to the presenter (visualization + insights)
+workflow.add_edge("analytical", "presenter")
+workflow.add_edge("semantic", "presenter")
 
 # Add an edge from tool agent to END (tool results are text, no visualization needed)
 workflow.add_edge("tool", END)
 
-# Add an edge from visualizer to insights_generator, then insights_generator to END
-workflow.add_edge("visualizer", "insights_generator")
-workflow.add_edge("insights_generator", END)
+# The presenter is the last step
+workflow.add_edge("presenter", END)
 
-# Compile the graph
+# Compile the graph once at import; every node is a coroutine function, so LangGraph
+# awaits them directly. No checkpointer: conversation history lives in Supermemory, and
+# a checkpointer would write a snapshot after every node and keep each thread in memory.
 app = workflow.compile()
 
@@ -3,99 +3,172 @@ import os
 from dotenv import load_dotenv
 import google.generativeai as genai
 import asyncio
+from typing import Optional
+
+from backend.cache import wiki_cache
+from backend.llm_utils import llm_text
 
 # Load environment variables
 load_dotenv()
 
-# GEMINI_API_KEY will be checked when get_definition is called
+# GEMINI_API_KEY will be checked when get_definition is called, and genai configured once
+_gemini_configured = False
+
+
+def _ensure_gemini_configured() -> bool:
+    """Configure genai on first use; returns False if GEMINI_API_KEY is not set."""
+    global _gemini_configured
+    if not _gemini_configured:
+        GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+        if not GEMINI_API_KEY:
+            return False
+        genai.configure(api_key=GEMINI_API_KEY)
+        _gemini_configured = True
+    return True
+
+
+# Shared Wikipedia client: its HTTP session (and keep-alive connections) is reused
+# across lookups. Wikipedia requires a user agent - use a descriptive one
+_WIKI_USER_AGENT = "QueryMind-EcommerceBot/1.0 (https://github.com/your-repo; your-email@example.com) Python"
+_wiki = wikipediaapi.Wikipedia(
+    language='en',
+    user_agent=_WIKI_USER_AGENT,
+    extract_format=wikipediaapi.ExtractFormat.WIKI
+)
+
+# Cached marker for topics Wikipedia has no usable article for
+_WIKI_NOT_FOUND = "__NOT_FOUND__"
+
+# Shared Gemini model, constructed once; the API client is resolved on first request,
+# so this is safe before genai.configure() runs
+gemini_model = genai.GenerativeModel('gemini-2.5-flash')
+
+# Upper bound (seconds) on a definition or translation call; the same setting the
+# orchestrator uses for its short Gemini calls
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', 6))
+
+
+# A single Wikipedia attempt, bounded by WIKI_TIMEOUT. If it hasn't answered after
+# WIKI_HEDGE_DELAY (or has no article), the Gemini definition is started alongside it
+# with its own GEMINI_TIMEOUT, and the first usable answer wins.
+WIKI_TIMEOUT = 8.0
+WIKI_HEDGE_DELAY = 5.0
+
+
+async def _fetch_wikipedia(topic: str, topic_key: str) -> Optional[str]:
+    """
+    Fetch a topic's Wikipedia summary (limited to 500 chars) and cache the outcome.
+    
+    Returns:
+        The summary, or None if there is no usable article or the request failed
+    """
+    def fetch_page():
+        # page() is lazy; exists() and summary do the HTTP requests
+        page = _wiki.page(topic)
+        return (True, page.summary) if page.exists() else (False, None)
+    
+    try:
+        # Run the blocking lookup in one executor call
+        exists, summary = await asyncio.get_running_loop().run_in_executor(None, fetch_page)
+    except Exception as e:
+        # Connection errors aren't cached, so the next lookup tries again
+        print(f"Wikipedia lookup error for '{topic}': {e}")
+        return None
+    
+    if not exists or not summary:
+        # Missing page or empty summary: remember the miss
+        wiki_cache.set(topic_key, _WIKI_NOT_FOUND)
+        return None
+    
+    # Return the summary (first few paragraphs, limit to 500 chars)
+    if len(summary) > 500:
+        summary = summary[:500] + "..."
+    wiki_cache.set(topic_key, summary)
+    return summary
 
 
 async def wikipedia_lookup(topic: str, fallback_to_gemini: bool = True) -> str:
     """
-    Fetch a Wikipedia summary for a given topic with retry logic and fallback.
+    Fetch a Wikipedia summary for a given topic, hedged with a Gemini definition.
     
     Args:
         topic: The topic to look up on Wikipedia
         fallback_to_gemini: If True, fall back to Gemini's get_definition if Wikipedia fails
+            or is slow
         
     Returns:
         A summary string from Wikipedia, or a fallback definition if Wikipedia fails
     """
-    max_retries = 3
-    retry_delay = 2  # Start with 2 seconds
+    # Repeat topics (found or not) skip the Wikipedia round-trip
+    topic_key = topic.strip().lower()
+    summary = wiki_cache.get(topic_key)
+    if summary == _WIKI_NOT_FOUND:
+        return await _wikipedia_fallback(topic, fallback_to_gemini)
+    if summary is not None:
+        return summary
     
-    for attempt in range(max_retries):
-        try:
-            # Wikipedia requires a user agent - use a descriptive one
-            user_agent = "QueryMind-EcommerceBot/1.0 (https://github.com/your-repo; your-email@example.com) Python"
-            
-            # Create Wikipedia instance with timeout settings
-            wiki_wiki = wikipediaapi.Wikipedia(
-                language='en',
-                user_agent=user_agent,
-                extract_format=wikipediaapi.ExtractFormat.WIKI
-            )
-            
-            # Set a timeout for the page fetch operation
-            # Run the blocking operation in an executor to allow timeout
-            try:
-                loop = asyncio.get_running_loop()
-            except RuntimeError:
-                # Fallback if no running loop (shouldn't happen in async function)
-                loop = asyncio.get_event_loop()
-            
-            page = await asyncio.wait_for(
-                loop.run_in_executor(None, lambda: wiki_wiki.page(topic)),
-                timeout=15.0  # 15 second timeout
-            )
-            
-            if page.exists():
-                # Get summary with timeout
-                summary = await asyncio.wait_for(
-                    loop.run_in_executor(None, lambda: page.summary),
-                    timeout=10.0  # 10 second timeout for summary
-                )
-                
-                if summary:
-                    # Return the summary (first few paragraphs, limit to 500 chars)
-                    if len(summary) > 500:
-                        summary = summary[:500] + "..."
-                    return summary
-                else:
-                    # Empty summary, try fallback
-                    break
-            else:
-                # Page doesn't exist, try fallback
-                break
-                
-        except asyncio.TimeoutError:
-            if attempt < max_retries - 1:
-                wait_time = retry_delay * (2 ** attempt)  # Exponential backoff
-                print(f"Wikipedia lookup timeout for '{topic}', retrying in {wait_time}s... (attempt {attempt + 1}/{max_retries})")
-                await asyncio.sleep(wait_time)
-            else:
-                print(f"Wikipedia lookup timed out for '{topic}' after {max_retries} attempts")
-                break
-        except Exception as e:
-            error_msg = str(e).lower()
-            # Check if it's a timeout or connection error
-            if 'timeout' in error_msg or 'connection' in error_msg or 'max retries' in error_msg:
-                if attempt < max_retries - 1:
-                    wait_time = retry_delay * (2 ** attempt)  # Exponential backoff
-                    print(f"Wikipedia connection error for '{topic}', retrying in {wait_time}s... (attempt {attempt + 1}/{max_retries})")
-                    await asyncio.sleep(wait_time)
-                else:
-                    print(f"Wikipedia connection failed for '{topic}' after {max_retries} attempts: {e}")
-                    break
-            else:
-                # Non-timeout error, don't retry
-                print(f"Wikipedia lookup error for '{topic}': {e}")
+    loop = asyncio.get_running_loop()
+    wiki_deadline = loop.time() + WIKI_TIMEOUT
+    wiki_task = asyncio.create_task(_fetch_wikipedia(topic, topic_key))
+    gemini_task = None
+    try:
+        if fallback_to_gemini:
+            # Start the Gemini definition once Wikipedia has missed or is slow
+            await asyncio.wait({wiki_task}, timeout=WIKI_HEDGE_DELAY)
+            if not wiki_task.done():
+                print(f"Wikipedia slow for '{topic}', starting Gemini definition in parallel")
+            if not _wiki_answered(wiki_task):
+                gemini_task = asyncio.create_task(get_definition(topic))
+        
+        # First usable answer wins: a Wikipedia summary (until WIKI_TIMEOUT), or a
+        # definition that isn't one of get_definition's error messages. The definition
+        # has its own GEMINI_TIMEOUT budget from when it started, so it is still awaited
+        # after Wikipedia's deadline passes
+        while True:
+            if _wiki_answered(wiki_task):
+                return wiki_task.result()
+            if gemini_task is not None and gemini_task.done() and not _is_definition_error(gemini_task.result()):
+                return gemini_task.result()
+            if not wiki_task.done() and loop.time() >= wiki_deadline:
+                print(f"Wikipedia lookup timed out for '{topic}' after {WIKI_TIMEOUT}s")
+                wiki_task.cancel()
+                await asyncio.wait({wiki_task})
+            pending = {task for task in (wiki_task, gemini_task) if task is not None and not task.done()}
+            if not pending:
                 break
-    
-    # If we get here, Wikipedia lookup failed - try fallback if enabled
+            await asyncio.wait(
+                pending,
+                timeout=wiki_deadline - loop.time() if wiki_task in pending else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+        
+        if gemini_task is not None:
+            # Wikipedia had nothing and the definition failed: report its error
+            return gemini_task.result()
+        return await _wikipedia_fallback(topic, fallback_to_gemini)
+    finally:
+        # Cancel whichever lookup lost the race
+        for task in (wiki_task, gemini_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+def _wiki_answered(wiki_task: asyncio.Task) -> bool:
+    """Whether the Wikipedia lookup finished with a summary (not cancelled or empty)."""
+    return wiki_task.done() and not wiki_task.cancelled() and bool(wiki_task.result())
+
+
+def _is_definition_error(definition: str) -> bool:
+    """get_definition reports failures as text; tell those apart from a definition."""
+    return definition.startswith("Error")
+
+
+async def _wikipedia_fallback(topic: str, fallback_to_gemini: bool) -> str:
+    """Answer for a topic Wikipedia couldn't provide: a Gemini definition if enabled, else a message."""
     if fallback_to_gemini:
         print(f"Falling back to Gemini definition for '{topic}'")
         try:
+            # get_definition is bounded by GEMINI_TIMEOUT
             return await get_definition(topic)
         except Exception as e:
             return f"Unable to fetch information about '{topic}'. Wikipedia lookup timed out and fallback also failed: {str(e)}"
@@ -115,19 +188,14 @@ async def get_definition(term: str) -> str:
     """
     try:
         # Check for API key when function is called
-        GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-        if not GEMINI_API_KEY:
+        if not _ensure_gemini_configured():
             return "Error: GEMINI_API_KEY must be set in .env file"
         
-        # Configure genai (idempotent - safe to call multiple times)
-        genai.configure(api_key=GEMINI_API_KEY)
-        
         prompt = f"In the context of Brazilian e-commerce, define this term simply: {term}. For example, 'boleto' is a Brazilian payment method."
         
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
-        
-        return response.text.strip()
+        return await llm_text(gemini_model, prompt, timeout=GEMINI_TIMEOUT)
+    except asyncio.TimeoutError:
+        return f"Error getting definition: timed out after {GEMINI_TIMEOUT}s"
     except Exception as e:
         return f"Error getting definition: {str(e)}"
 
@@ -144,19 +212,14 @@ async def translate_to_english(text: str) -> str:
     """
     try:
         # Check for API key when function is called
-        GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-        if not GEMINI_API_KEY:
+        if not _ensure_gemini_configured():
             return "Error: GEMINI_API_KEY must be set in .env file"
         
-        # Configure genai (idempotent - safe to call multiple times)
-        genai.configure(api_key=GEMINI_API_KEY)
-        
         prompt = f"Translate the following text to English. If it's already in English, return it as is. Only return the translation, no explanations:\n\n{text}"
         
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
-        
-        return response.text.strip()
+        return await llm_text(gemini_model, prompt, timeout=GEMINI_TIMEOUT)
+    except asyncio.TimeoutError:
+        return f"Translation error: timed out after {GEMINI_TIMEOUT}s"
     except Exception as e:
         return f"Translation error: {str(e)}"
 
@@ -1,7 +1,16 @@
+import asyncio
+import concurrent.futures
+import functools
+import threading
 import chromadb
-from openai import OpenAI
+import httpx
+import numpy as np
+from openai import AsyncOpenAI
 import os
 from dotenv import load_dotenv
+from typing import Dict, List
+
+from backend.cache import embedding_cache, make_key
 
 # Load environment variables
 load_dotenv()
@@ -11,7 +20,17 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY must be set in .env file")
 
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# One async client for the process so its httpx connection pool (and TLS sessions) is
+# reused across concurrent requests; bounded retries and timeouts keep a slow
+# embeddings call from stalling a request
+openai_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=2,
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    )
+)
 
 # Use the same embedding model that was used to create the ChromaDB embeddings
 EMBEDDING_MODEL = "text-embedding-3-small"
@@ -19,20 +38,179 @@ EMBEDDING_MODEL = "text-embedding-3-small"
 # Initialize ChromaDB client
 client = chromadb.PersistentClient(path="./chroma_db")
 
-# Collection will be loaded lazily
+# Dedicated threads for Chroma searches: bounds concurrent HNSW queries and keeps them
+# from queuing behind embeddings/Wikipedia calls in the default executor
+_CHROMA_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="chroma")
+
+# Collection will be loaded lazily, once, by whichever thread asks first
 _collection = None
+_collection_lock = threading.Lock()
 
 def get_collection():
     """Get the products collection, creating it if it doesn't exist."""
     global _collection
-    if _collection is None:
-        try:
-            _collection = client.get_collection(name="products")
-        except Exception:
-            # If collection doesn't exist, create it
-            _collection = client.get_or_create_collection(name="products")
+    if _collection is not None:
+        return _collection
+    with _collection_lock:
+        if _collection is None:
+            try:
+                _collection = client.get_collection(name="products")
+            except Exception:
+                # If collection doesn't exist, create it
+                _collection = client.get_or_create_collection(name="products")
     return _collection
 
+# Embedding requests in flight, so concurrent callers with the same text share one call
+_embedding_inflight: Dict[str, asyncio.Future] = {}
+
+
+def _embedding_key(text: str) -> str:
+    return make_key(EMBEDDING_MODEL, text.strip().lower())
+
+
+def warm_collection() -> int:
+    """
+    Open the products collection ahead of the first search (blocking; run it in a thread).
+    
+    Returns:
+        The number of items in the collection
+    """
+    return get_collection().count()
+
+
+async def close_openai_client():
+    """Close the OpenAI client's connection pool."""
+    await openai_client.close()
+
+
+def _query_collection(query_embeddings: List[List[float]], n_results: int):
+    return get_collection().query(query_embeddings=query_embeddings, n_results=n_results)
+
+
+async def embed_query(query_text: str):
+    """
+    Embed a query with the same OpenAI model used for the ChromaDB collection.
+    Results are cached, and concurrent requests for the same text share one API call.
+    
+    Args:
+        query_text: The text to embed
+    
+    Returns:
+        The embedding vector as a float32 numpy array
+    """
+    key = _embedding_key(query_text)
+    embedding = embedding_cache.get(key)
+    if embedding is not None:
+        return embedding
+    
+    inflight = _embedding_inflight.get(key)
+    if inflight is not None:
+        # Shield so one waiter being cancelled doesn't cancel the shared request
+        return await asyncio.shield(inflight)
+    
+    future = asyncio.get_running_loop().create_future()
+    _embedding_inflight[key] = future
+    try:
+        response = await openai_client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=query_text
+        )
+        embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+        embedding_cache.set(key, embedding)
+        future.set_result(embedding)
+        return embedding
+    except BaseException as e:
+        future.set_exception(e)
+        # Mark retrieved so a request nobody else was waiting on doesn't log a warning
+        future.exception()
+        raise
+    finally:
+        _embedding_inflight.pop(key, None)
+
+
+async def semantic_search_batch(query_texts: List[str], n_results: int = 5) -> List[List[str]]:
+    """
+    Perform semantic search for several queries at once: one OpenAI embeddings
+    request for all texts and one ChromaDB query for all embeddings.
+    
+    Args:
+        query_texts: The query texts to search for
+        n_results: Number of results to return per query (default: 5)
+    
+    Returns:
+        One list of product_ids per query, in the same order as query_texts
+    """
+    # Serve cached embeddings and request only the misses, in one call
+    keys = [_embedding_key(text) for text in query_texts]
+    query_embeddings = [embedding_cache.get(key) for key in keys]
+    missing = [i for i, embedding in enumerate(query_embeddings) if embedding is None]
+    if missing:
+        response = await openai_client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=[query_texts[i] for i in missing]
+        )
+        for i, item in zip(missing, response.data):
+            query_embeddings[i] = np.asarray(item.embedding, dtype=np.float32)
+            embedding_cache.set(keys[i], query_embeddings[i])
+    
+    # Query ChromaDB (HNSW index) with all embeddings in a single call. The search is
+    # local and CPU-bound, so run it on the Chroma pool to keep the event loop serving others
+    results = await asyncio.get_running_loop().run_in_executor(
+        _CHROMA_POOL,
+        functools.partial(_query_collection, query_embeddings, n_results)
+    )
+    
+    # Extract the list of product_ids per query from the results['metadatas']
+    metadatas = (results or {}).get('metadatas') or []
+    product_ids = []
+    for i in range(len(query_texts)):
+        query_metadatas = metadatas[i] if i < len(metadatas) else []
+        product_ids.append([m['product_id'] for m in query_metadatas if 'product_id' in m])
+    return product_ids
+
+
+class _SearchBatcher:
+    """
+    Micro-batcher for semantic_search: queries arriving within `window` seconds
+    are sent together through semantic_search_batch and the results scattered
+    back to each caller's future.
+    """
+    
+    def __init__(self, window: float = 0.005):
+        self.window = window
+        self._pending = []
+        self._flush_task = None
+    
+    async def submit(self, query_text: str, n_results: int) -> List[str]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query_text, n_results, future))
+        if len(self._pending) == 1:
+            loop.call_later(self.window, self._schedule_flush)
+        return await future
+    
+    def _schedule_flush(self):
+        self._flush_task = asyncio.create_task(self._flush())
+    
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        # Chroma returns nearest-first, so querying with the largest n serves every caller
+        max_results = max(n for _, n, _ in batch)
+        try:
+            results = await semantic_search_batch([q for q, _, _ in batch], max_results)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, n, future), product_ids in zip(batch, results):
+            if not future.done():
+                future.set_result(product_ids[:n])
+
+
+_search_batcher = _SearchBatcher()
+
+
 async def semantic_search(query_text: str, n_results: int = 5):
     """
     Perform semantic search on the products collection.
@@ -48,30 +226,8 @@ async def semantic_search(query_text: str, n_results: int = 5):
         List of product_ids from the search results
     """
     try:
-        # Get the query embedding using OpenAI (same model as used for ChromaDB)
-        response = openai_client.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=query_text
-        )
-        
-        # Extract embedding from response
-        query_embedding = response.data[0].embedding
-        
-        # Query ChromaDB with the embedding
-        collection = get_collection()
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=n_results
-        )
-        
-        # Extract and return the list of product_ids from the results['metadatas']
-        product_ids = []
-        if results and results.get('metadatas') and len(results['metadatas']) > 0:
-            for metadata in results['metadatas'][0]:
-                if 'product_id' in metadata:
-                    product_ids.append(metadata['product_id'])
-        
-        return product_ids
+        # Concurrent searches are coalesced into one embeddings call + one Chroma query
+        return await _search_batcher.submit(query_text, n_results)
     except Exception as e:
         error_msg = str(e)
         # Check if it's a quota/rate limit error
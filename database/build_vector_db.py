@@ -1,10 +1,15 @@
-import pandas as pd
+import numpy as np
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 import os
+import random
+import sys
 import chromadb
+import openai
 from openai import OpenAI
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 # Load environment variables from .env file
 load_dotenv()
@@ -24,13 +29,14 @@ openai_client = OpenAI(api_key=OPENAI_API_KEY)
 # Create SQLAlchemy engine
 engine = create_engine(DATABASE_URL)
 
-# SQL query to fetch product data with reviews
+# SQL query to fetch product data with reviews. Reviews are cut to the 1000 characters
+# that go into each document on the server, so only those are transferred
 sql_query = """
 SELECT 
     p.product_id, 
     p.product_category_name, 
-    t.product_category_name_english, 
-    STRING_AGG(r.review_comment_message, ' ') as reviews 
+    COALESCE(t.product_category_name_english, '') as product_category_name_english, 
+    LEFT(STRING_AGG(r.review_comment_message, ' '), 1000) as reviews 
 FROM products p 
 LEFT JOIN product_category_translation t ON p.product_category_name = t.product_category_name 
 LEFT JOIN order_items oi ON p.product_id = oi.product_id 
@@ -39,13 +45,6 @@ WHERE r.review_comment_message IS NOT NULL
 GROUP BY p.product_id, p.product_category_name, t.product_category_name_english
 """
 
-print("Executing SQL query to fetch product data...")
-# Execute query and load into pandas DataFrame
-with engine.connect() as conn:
-    df = pd.read_sql(text(sql_query), conn)
-
-print(f"Loaded {len(df)} products with reviews into DataFrame")
-
 # Initialize ChromaDB client
 print("Initializing ChromaDB client...")
 client = chromadb.PersistentClient(path="./chroma_db")
@@ -54,58 +53,152 @@ client = chromadb.PersistentClient(path="./chroma_db")
 print("Creating 'products' collection...")
 collection = client.get_or_create_collection(name="products")
 
+# Products already in the collection were embedded by an earlier run: only embed the
+# new ones, unless a full rebuild is requested with --full
+existing_ids = set()
+if '--full' not in sys.argv:
+    existing_ids = set(collection.get(include=[])['ids'])
+    if existing_ids:
+        print(f"Skipping {len(existing_ids)} products already in the collection")
+
 # Initialize OpenAI EmbeddingModel
 print("Initializing OpenAI EmbeddingModel...")
 # Use OpenAI text-embedding-3-small for embeddings
 embedding_model = "text-embedding-3-small"
 
-# Iterate through DataFrame and add to ChromaDB
-print("Processing products and creating embeddings...")
-for idx, row in df.iterrows():
-    # Create text document
-    reviews_text = str(row['reviews'])[:1000] if pd.notna(row['reviews']) else ""
-    category = str(row['product_category_name_english']) if pd.notna(row['product_category_name_english']) else ""
-    document = f"Product ID: {row['product_id']}\nCategory: {category}\nReviews: {reviews_text}"
+# Products per embeddings request (the API accepts up to 2048 inputs per call)
+BATCH_SIZE = 512
+
+# Embedding requests in flight at once; the work is network-bound, so threads overlap it
+EMBEDDING_WORKERS = int(os.getenv('EMBEDDING_WORKERS', 4))
+
+
+# Embeddings token budget per minute for the account's tier (text-embedding-3-small)
+OPENAI_EMBEDDING_TPM = int(os.getenv('OPENAI_EMBEDDING_TPM', 1_000_000))
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: refills at `rate_per_minute` and holds at most that many
+    tokens. acquire() only sleeps when the bucket can't cover the request.
+    """
+    
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60.0
+        self.tokens = float(rate_per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
     
-    # Create embedding using OpenAI with retry logic
-    max_retries = 3
+    def acquire(self, amount):
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_time = (amount - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+token_bucket = TokenBucket(OPENAI_EMBEDDING_TPM)
+
+
+def retry_wait(error, attempt, retry_delay):
+    """
+    Seconds to wait before retrying a failed embedding request. Rate limits honor the
+    server's Retry-After header; other errors back off exponentially (capped at 30s).
+    Both add jitter so concurrent workers don't retry in lockstep.
+    """
+    if isinstance(error, openai.RateLimitError):
+        retry_after = error.response.headers.get('retry-after')
+        try:
+            return float(retry_after) + random.uniform(0, 0.5)
+        except (TypeError, ValueError):
+            pass
+    return min(retry_delay * (2 ** attempt), 30) + random.uniform(0, 1)
+
+
+def embed_documents(documents):
+    """Embed a batch of documents in one OpenAI request, with rate limiting and retry logic."""
+    max_retries = 5
     retry_delay = 1
     
+    # Roughly 4 characters per token
+    token_bucket.acquire(sum(len(document) for document in documents) // 4)
+    
     for attempt in range(max_retries):
         try:
             response = openai_client.embeddings.create(
                 model=embedding_model,
-                input=document
+                input=documents
             )
-            
-            # Extract embedding values from result
-            embedding = response.data[0].embedding
-            
-            # Add to ChromaDB
-            collection.add(
-                documents=[document],
-                metadatas=[{'product_id': str(row['product_id'])}],
-                embeddings=[embedding],
-                ids=[str(row['product_id'])]
-            )
-            
-            break  # Success, exit retry loop
-            
+            # Embeddings come back in input order. Held as one float32 array (the
+            # precision ChromaDB stores) rather than lists of Python floats, which take
+            # ~8x the memory while batches wait to be written
+            return np.array([item.embedding for item in response.data], dtype=np.float32)
         except Exception as e:
             if attempt < max_retries - 1:
-                wait_time = retry_delay * (2 ** attempt)  # Exponential backoff
-                print(f"Error on product {idx + 1}, retrying in {wait_time}s... (attempt {attempt + 1}/{max_retries})")
+                wait_time = retry_wait(e, attempt, retry_delay)
+                print(f"Embedding request failed, retrying in {wait_time:.1f}s... (attempt {attempt + 1}/{max_retries})")
                 time.sleep(wait_time)
             else:
-                print(f"Failed to process product {idx + 1} after {max_retries} attempts: {e}")
+                print(f"Embedding request failed after {max_retries} attempts: {e}")
                 raise
+
+
+def build_batch(rows):
+    """Create the text documents for a batch of product rows and embed them."""
+    # Category and reviews are never NULL and reviews are already truncated (see sql_query)
+    product_ids = [str(row.product_id) for row in rows]
+    documents = [
+        f"Product ID: {product_id}\nCategory: {row.product_category_name_english}\nReviews: {row.reviews}"
+        for product_id, row in zip(product_ids, rows)
+    ]
+    return product_ids, documents, embed_documents(documents)
+
+
+def write_batch(future):
+    """Write a finished batch to ChromaDB and return its size."""
+    ids, documents, embeddings = future.result()
+    # Write the whole batch to ChromaDB; upsert keeps reruns from tripping over existing ids
+    collection.upsert(
+        documents=documents,
+        metadatas=[{'product_id': product_id} for product_id in ids],
+        embeddings=embeddings,
+        ids=ids
+    )
+    return len(ids)
+
+
+# Stream products from a server-side cursor one batch at a time, embed batches
+# concurrently, and write each to ChromaDB (from this thread) as it completes.
+# At most 2 * EMBEDDING_WORKERS batches are held in memory at once.
+print(f"Processing products and creating embeddings ({EMBEDDING_WORKERS} concurrent requests)...")
+processed = 0
+in_flight = set()
+with engine.connect().execution_options(stream_results=True) as conn, \
+        ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS) as executor:
+    # Rows are used directly; no DataFrame is built
+    for rows in conn.execute(text(sql_query)).partitions(BATCH_SIZE):
+        if existing_ids:
+            rows = [row for row in rows if str(row.product_id) not in existing_ids]
+        if not rows:
+            continue
+        
+        in_flight.add(executor.submit(build_batch, rows))
+        if len(in_flight) >= 2 * EMBEDDING_WORKERS:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                processed += write_batch(future)
+            print(f"Processed {processed} products...")
     
-    # Rate limiting: small delay between requests
-    time.sleep(0.1)
-    
-    if (idx + 1) % 100 == 0:
-        print(f"Processed {idx + 1}/{len(df)} products...")
+    for future in as_completed(in_flight):
+        processed += write_batch(future)
+        print(f"Processed {processed} products...")
 
-print(f"\nSuccessfully built vector database with {len(df)} products!")
+print(f"\nEmbedded {processed} products; vector database now holds {collection.count()} products!")
 print(f"ChromaDB collection 'products' is ready at ./chroma_db")
-
@@ -1,3 +1,6 @@
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
@@ -40,27 +43,133 @@ date_columns = [
     'order_estimated_delivery_date'
 ]
 
-# Loop through the dictionary of tables
-for table_name, csv_path in table_csv_mapping.items():
-    print(f"Loading {table_name} from {csv_path}...")
+def copy_insert(table, conn, keys, data_iter):
+    """
+    to_sql insertion method that streams rows through Postgres COPY ... FROM STDIN
+    (psycopg2), skipping per-row INSERT parsing. None values are written as empty
+    unquoted fields, which COPY's CSV format reads as NULL.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(data_iter)
+    buffer.seek(0)
     
-    # Read the CSV into a pandas DataFrame
-    df = pd.read_csv(csv_path)
+    columns = ', '.join(f'"{key}"' for key in keys)
+    table_name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT CSV)", buffer)
+
+
+# Rows parsed and inserted at a time, so memory stays bounded and parsing of the
+# next chunk follows each insert instead of waiting for the whole file
+CSV_CHUNK_ROWS = 100_000
+
+# Tables loaded at once; each load uses its own pooled connection
+LOAD_WORKERS = 4
+
+
+def read_constraints():
+    """
+    Read the foreign keys and secondary indexes on the loaded tables from the catalog,
+    so they are rebuilt exactly as schema.sql (or any later migration) defined them.
     
-    # For any column in the DataFrame that is in our date_columns list, convert it to datetime
-    for col in df.columns:
-        if col in date_columns:
-            df[col] = pd.to_datetime(df[col], errors='coerce')
+    Returns:
+        Two lists of SQL statements: the ones that drop them and the ones that recreate them
+    """
+    tables = list(table_csv_mapping)
+    with engine.connect() as conn:
+        foreign_keys = conn.exec_driver_sql("""
+            SELECT conrelid::regclass::text, quote_ident(conname), pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE contype = 'f' AND connamespace = current_schema()::regnamespace
+              AND conrelid::regclass::text = ANY(%s)
+        """, (tables,)).fetchall()
+        # Indexes backing a primary key or unique constraint stay in place
+        indexes = conn.exec_driver_sql("""
+            SELECT quote_ident(indexname), indexdef
+            FROM pg_indexes
+            WHERE schemaname = current_schema() AND tablename = ANY(%s)
+              AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE contype IN ('p', 'u', 'x'))
+        """, (tables,)).fetchall()
     
-    # Use df.to_sql() to load the data into the correct table
-    df.to_sql(
-        name=table_name,
-        con=engine,
-        if_exists='append',
-        index=False
+    drop_statements = (
+        [f"ALTER TABLE {table} DROP CONSTRAINT {name}" for table, name, _ in foreign_keys]
+        + [f"DROP INDEX {name}" for name, _ in indexes]
+    )
+    create_statements = (
+        [definition for _, definition in indexes]
+        + [f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}" for table, name, definition in foreign_keys]
     )
+    return drop_statements, create_statements
+
+
+def drop_constraints(drop_statements):
+    """Drop the foreign keys and secondary indexes before loading."""
+    with engine.begin() as conn:
+        for statement in drop_statements:
+            conn.exec_driver_sql(statement)
+
+
+def recreate_constraints(create_statements):
+    """Rebuild the secondary indexes and foreign keys after loading, in one transaction."""
+    try:
+        with engine.begin() as conn:
+            # More sort memory lets each index and FK check run in one pass
+            conn.exec_driver_sql("SET LOCAL maintenance_work_mem = '1GB'")
+            for statement in create_statements:
+                conn.exec_driver_sql(statement)
+    except Exception:
+        # E.g. the loaded rows violate a foreign key: leave the exact steps to finish by hand
+        print("\nRecreating indexes and foreign keys failed. Fix the data, then run:")
+        for statement in create_statements:
+            print(f"    {statement};")
+        raise
+
+
+def load_table(table_name):
+    """Load one table from its CSV in chunks and return the number of rows loaded."""
+    csv_path = table_csv_mapping[table_name]
+    print(f"Loading {table_name} from {csv_path}...")
+    
+    # Date columns present in this file, read from its header
+    header = pd.read_csv(csv_path, nrows=0).columns
+    file_date_columns = [col for col in header if col in date_columns]
     
-    print(f"Successfully loaded {len(df)} rows into {table_name}")
+    # Read the CSV in chunks and append each to the table
+    row_count = 0
+    for chunk in pd.read_csv(csv_path, chunksize=CSV_CHUNK_ROWS):
+        # Convert date columns to datetime (unparseable values become NaT)
+        for col in file_date_columns:
+            chunk[col] = pd.to_datetime(chunk[col], errors='coerce')
+        
+        # Use to_sql() to load the chunk into the correct table with a single COPY
+        chunk.to_sql(
+            name=table_name,
+            con=engine,
+            if_exists='append',
+            index=False,
+            method=copy_insert
+        )
+        row_count += len(chunk)
+    
+    print(f"Successfully loaded {row_count} rows into {table_name}")
+    return row_count
 
-print("\nAll data loaded successfully!")
 
+# Foreign keys and secondary indexes are dropped for the bulk load and rebuilt once
+# afterwards: one pass over each table is much cheaper than maintaining them row by row
+drop_statements, create_statements = read_constraints()
+print("Dropping foreign keys and indexes for the bulk load...")
+drop_constraints(drop_statements)
+
+try:
+    # With no foreign keys to order the loads, every table loads concurrently, overlapping
+    # CSV parsing of one table with the COPY of another. list() re-raises the first failure
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+        list(executor.map(load_table, table_csv_mapping))
+finally:
+    # Rebuilt even if a load failed, so the database never keeps running without them.
+    # Adding the foreign keys validates all loaded rows against their parents
+    print("Recreating indexes and foreign keys...")
+    recreate_constraints(create_statements)
+
+print("\nAll data loaded successfully!")
@@ -1,7 +1,7 @@
 -- Olist Brazilian E-commerce Database Schema
 
 -- Customers table
-CREATE TABLE customers (
+CREATE TABLE IF NOT EXISTS customers (
     customer_id TEXT PRIMARY KEY,
     customer_unique_id TEXT,
     customer_zip_code_prefix TEXT,
@@ -10,7 +10,7 @@ CREATE TABLE customers (
 );
 
 -- Sellers table
-CREATE TABLE sellers (
+CREATE TABLE IF NOT EXISTS sellers (
     seller_id TEXT PRIMARY KEY,
     seller_zip_code_prefix TEXT,
     seller_city TEXT,
@@ -18,7 +18,7 @@ CREATE TABLE sellers (
 );
 
 -- Products table
-CREATE TABLE products (
+CREATE TABLE IF NOT EXISTS products (
     product_id TEXT PRIMARY KEY,
     product_category_name TEXT,
     product_name_lenght FLOAT,
@@ -31,13 +31,13 @@ CREATE TABLE products (
 );
 
 -- Product category translation table
-CREATE TABLE product_category_translation (
+CREATE TABLE IF NOT EXISTS product_category_translation (
     product_category_name TEXT PRIMARY KEY,
     product_category_name_english TEXT
 );
 
 -- Orders table
-CREATE TABLE orders (
+CREATE TABLE IF NOT EXISTS orders (
     order_id TEXT PRIMARY KEY,
     customer_id TEXT,
     order_status TEXT,
@@ -50,7 +50,7 @@ CREATE TABLE orders (
 );
 
 -- Order items table
-CREATE TABLE order_items (
+CREATE TABLE IF NOT EXISTS order_items (
     order_id TEXT,
     order_item_id INTEGER,
     product_id TEXT,
@@ -65,7 +65,7 @@ CREATE TABLE order_items (
 );
 
 -- Order payments table
-CREATE TABLE order_payments (
+CREATE TABLE IF NOT EXISTS order_payments (
     order_id TEXT,
     payment_sequential INTEGER,
     payment_type TEXT,
@@ -75,7 +75,7 @@ CREATE TABLE order_payments (
 );
 
 -- Order reviews table
-CREATE TABLE order_reviews (
+CREATE TABLE IF NOT EXISTS order_reviews (
     review_id TEXT PRIMARY KEY,
     order_id TEXT,
     review_score INTEGER,
@@ -87,7 +87,7 @@ CREATE TABLE order_reviews (
 );
 
 -- Geolocation table
-CREATE TABLE geolocation (
+CREATE TABLE IF NOT EXISTS geolocation (
     geolocation_zip_code_prefix TEXT,
     geolocation_lat DECIMAL(10, 8),
     geolocation_lng DECIMAL(10, 8),
@@ -96,5 +96,5 @@ CREATE TABLE geolocation (
 );
 
 -- Index on geolocation_zip_code_prefix
-CREATE INDEX idx_geolocation_zip_code_prefix ON geolocation(geolocation_zip_code_prefix);
+CREATE INDEX IF NOT EXISTS idx_geolocation_zip_code_prefix ON geolocation(geolocation_zip_code_prefix);
 
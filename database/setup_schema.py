@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -20,19 +20,10 @@ with open(schema_file, 'r') as f:
 
 print("Creating database schema...")
 
-# Execute the schema SQL
+# Execute the whole schema in one round-trip; the statements use IF NOT EXISTS, so
+# rerunning against an existing database is a no-op
 with engine.begin() as conn:
-    # Split by semicolons and execute each statement
-    statements = [s.strip() for s in schema_sql.split(';') if s.strip() and not s.strip().startswith('--')]
-    
-    for statement in statements:
-        if statement:
-            try:
-                conn.execute(text(statement))
-            except Exception as e:
-                # Ignore errors for "already exists" cases
-                if 'already exists' not in str(e).lower() and 'duplicate' not in str(e).lower():
-                    print(f"Warning: {e}")
+    conn.exec_driver_sql(schema_sql)
 
 print("Database schema created successfully!")
 
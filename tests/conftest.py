@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Make the backend package importable and satisfy the import-time API key checks;
+# tests never call the real services
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('GEMINI_API_KEY', 'test')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
@@ -0,0 +1,36 @@
+import asyncio
+
+from backend import orchestrator
+from backend.cache import intent_cache, make_key, normalize_query
+
+
+def test_batches_llm_calls_and_fills_intent_cache(monkeypatch):
+    intent_cache.clear()
+    calls = []
+
+    async def fake_llm_json(model, prompt, schema, **kwargs):
+        calls.append(prompt)
+        # One reply per query in the batch; the second is not a valid intent
+        return {"intents": ["semantic", "Unknown", "tool"]}
+
+    monkeypatch.setattr(orchestrator, "llm_json", fake_llm_json)
+    queries = [
+        "good quality phones",
+        "top 10 products by revenue",  # keyword fast path, never sent to Gemini
+        "hello there",
+        "what is boleto",
+    ]
+
+    intents = asyncio.run(orchestrator.classify_queries(queries))
+
+    assert intents == ["semantic", "analytical", "conversational", "tool"]
+    assert len(calls) == 1
+    no_context = orchestrator._compact_context({})
+    assert intent_cache.get(make_key(normalize_query("good quality phones"), no_context)) == "semantic"
+    assert intent_cache.get(make_key(normalize_query("what is boleto"), no_context)) == "tool"
+    # Invalid replies fall back without being cached
+    assert intent_cache.get(make_key(normalize_query("hello there"), no_context)) is None
+
+    # Cached queries are answered without another Gemini call
+    assert asyncio.run(orchestrator.classify_queries(["good quality phones"])) == ["semantic"]
+    assert len(calls) == 1
@@ -0,0 +1,35 @@
+import pytest
+
+from backend.orchestrator import _safeguard_sql
+
+
+def test_semicolon_inside_e_string_is_kept():
+    sql = "SELECT E'it\\'s; x' FROM t; DROP TABLE t"
+    assert _safeguard_sql(sql) == "SELECT E'it\\'s; x' FROM t\nLIMIT 10000"
+
+
+def test_semicolon_inside_dollar_quotes_is_kept():
+    assert _safeguard_sql("SELECT $$a;b$$") == "SELECT $$a;b$$\nLIMIT 10000"
+    assert _safeguard_sql("SELECT $q$a;$$b$q$ FROM t; DROP TABLE t") == "SELECT $q$a;$$b$q$ FROM t\nLIMIT 10000"
+
+
+def test_parenthesised_set_query_is_allowed():
+    assert _safeguard_sql("(SELECT 1) UNION (SELECT 2)") == "(SELECT 1) UNION (SELECT 2)\nLIMIT 10000"
+
+
+def test_semicolon_inside_plain_literal_and_identifier_is_kept():
+    assert _safeguard_sql("SELECT \"a;b\" FROM t WHERE c = 'x;y'") == "SELECT \"a;b\" FROM t WHERE c = 'x;y'\nLIMIT 10000"
+
+
+def test_leading_comment_is_stripped():
+    assert _safeguard_sql("-- top sellers\nSELECT * FROM t LIMIT 5") == "SELECT * FROM t LIMIT 5"
+
+
+def test_existing_row_limits_are_kept():
+    assert _safeguard_sql("SELECT * FROM t LIMIT 10 OFFSET 5;") == "SELECT * FROM t LIMIT 10 OFFSET 5"
+    assert _safeguard_sql("SELECT * FROM t FETCH FIRST 5 ROWS ONLY") == "SELECT * FROM t FETCH FIRST 5 ROWS ONLY"
+
+
+def test_non_select_is_rejected():
+    with pytest.raises(ValueError):
+        _safeguard_sql("/* cleanup */ DELETE FROM t")